@@ -0,0 +1,218 @@
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+from functools import partial
+from json import loads
+from os.path import join
+
+import aiohttp
+from hdx.data.hdxobject import HDXError
+from hdx.utilities.retriever import DownloadError
+from hdx.utilities.saver import save_json
+from requests.exceptions import ConnectionError, Timeout
+
+from instrumentation import run_report
+from resilience import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+transient_errors = (aiohttp.ClientConnectionError, asyncio.TimeoutError, ConnectionError, Timeout)
+
+
+class AsyncCOD:
+    # asyncio counterparts of the COD methods that do network I/O. ITOS requests go through one pooled keep-alive
+    # aiohttp session while the HDX library, which is synchronous, runs in a thread pool of the same size
+    def __init__(self, cod, concurrency=10, timeout=60):
+        self.cod = cod
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.session = None
+        self.semaphore = None
+        self.executor = None
+
+    async def __aenter__(self):
+        headers = dict()
+        user_agent = self.cod.retriever.downloader.session.headers.get("User-Agent")
+        if user_agent:
+            headers["User-Agent"] = user_agent
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers=headers,
+        )
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.session.close()
+        self.executor.shutdown()
+
+    async def to_thread(self, function, *args, **kwargs):
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(function, *args, **kwargs))
+
+    async def download(self, url):
+        async with self.semaphore:
+            with run_report.stage("download"):
+                async with self.session.get(url) as response:
+                    response.raise_for_status()
+                    body = await response.read()
+        run_report.add("bytes_downloaded", len(body))
+        return body
+
+    def use_retriever(self):
+        # saved data and the HTTP cache are read through the synchronous retriever, in the thread pool, so that runs
+        # can be replayed offline and share cached responses whichever engine made them
+        retriever = self.cod.retriever
+        return retriever.use_saved or getattr(retriever, "http_cache", None)
+
+    async def download_json(self, url, file_prefix=None):
+        if self.use_retriever():
+            return await self.to_thread(lambda: self.cod.get_retriever().download_json(url, file_prefix=file_prefix))
+        retriever = self.cod.retriever
+        rjson = loads(await self.download(url))
+        if retriever.save:
+            filename, _ = retriever.get_filename(url, None, ("json",), file_prefix=file_prefix)
+            save_json(rjson, join(retriever.saved_dir, filename))
+        return rjson
+
+    async def download_catalogue(self, url):
+        if self.use_retriever():
+            return await self.to_thread(self.cod.download_catalogue, url)
+        retriever = self.cod.retriever
+        filename, _ = retriever.get_filename(url, None, ("json",))
+        # as in Retrieve.download_file, downloads are written to the saved data folder when saving
+        path = join(retriever.saved_dir if retriever.save else retriever.temp_dir, filename)
+        with run_report.stage("catalogue"):
+            body = await self.cod.upstreams["catalogue"].call_async(
+                self.download, url, transient_errors=transient_errors
+            )
+        with open(path, "wb") as f:
+            f.write(body)
+        return path
+
+    async def get_datasets_metadata(self, url, countries=None, enhanced_only=True, boundaries_only=True):
+        path = None
+        if url not in self.cod.catalogues:
+            path = await self.download_catalogue(url)
+        return await self.to_thread(self.cod.get_datasets_metadata, url, countries, enhanced_only, boundaries_only, path)
+
+    async def generate_dataset(self, metadata, latest_only=True):
+        result = await self.to_thread(self.cod._generate_dataset, metadata, latest_only)
+        return self.cod.add_generated_dataset(*result)
+
+    @staticmethod
+    async def map_ahead(function, iterable, window):
+        # yields results in input order with at most window calls in flight, cancelling those in flight if the
+        # caller stops iterating
+        tasks = deque()
+        try:
+            for item in iterable:
+                tasks.append(asyncio.ensure_future(function(item)))
+                if len(tasks) == window:
+                    yield await tasks.popleft()
+            while tasks:
+                yield await tasks.popleft()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def generate_datasets(self, datasets_metadata, latest_only=True):
+        # datasets are yielded as they are generated, with errors and batches resolved in input order as in
+        # COD.generate_datasets, so that they can be handed on without holding all of them
+        generate = partial(self.to_thread, self.cod._generate_dataset, latest_only=latest_only)
+        async with aclosing(self.map_ahead(generate, datasets_metadata, self.concurrency * 2)) as results:
+            async for result in results:
+                yield self.cod.add_generated_dataset(*result)
+
+    async def get_population_year(self, url, adm):
+        # as COD.get_population_year with the probe awaited
+        found, result = self.cod.get_cached_population_year(url, adm)
+        if found:
+            return result
+        try:
+            with run_report.stage("population_probe"):
+                year = await self.cod.upstreams["population"].call_async(
+                    self.download_json, url, file_prefix=str(adm), transient_errors=transient_errors
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError, DownloadError, FileNotFoundError) as ex:
+            return self.cod.get_failed_population_year(ex, transient_errors)
+        return self.cod.set_population_year(url, adm, year)
+
+    async def get_population_years(self, iso, url, window=2):
+        # admin levels are probed in order up to the first missing one with window levels probed at once as in
+        # COD.get_population_years
+        urls = self.cod.get_population_urls(iso, url)
+
+        def probe(adm):
+            return self.get_population_year(urls[adm], adm)
+
+        years = dict()
+        async with aclosing(self.map_ahead(probe, range(len(urls)), window)) as results:
+            adm = 0
+            async for exists, year in results:
+                if not self.cod.add_population_year(years, urls, adm, exists, year):
+                    break
+                adm += 1
+        return years
+
+    async def set_population_resources(self, dataset, iso, url):
+        try:
+            years = await self.get_population_years(iso, url)
+        except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError, DownloadError) as ex:
+            return None, [self.cod.get_probe_error(dataset, ex)]
+        return self.cod.set_population_resources(dataset, iso, years)
+
+    async def add_population_services(self, dataset, iso, url):
+        return self.cod.add_population_dataset(*await self.set_population_resources(dataset, iso, url))
+
+    async def generate_population_dataset(self, iso, url):
+        name = f"cod-ps-{iso.lower()}"
+        try:
+            dataset = await self.to_thread(self.cod.hdx_datasets.read, name)
+        except (CircuitOpenError, HDXError) as ex:
+            return None, [self.cod.get_read_error(name, ex)]
+        if not dataset:
+            return None, list()
+        return await self.set_population_resources(dataset, iso, url)
+
+    async def generate_population_datasets(self, countries, url):
+        generate = partial(self.generate_population_dataset, url=url)
+        async with aclosing(self.map_ahead(generate, countries, self.concurrency * 2)) as results:
+            async for result in results:
+                yield self.cod.add_population_dataset(*result)
+
+
+def run_async(cod, concurrency, method, *args, **kwargs):
+    # runs one AsyncCOD method to completion from synchronous code
+    async def call():
+        async with AsyncCOD(cod, concurrency) as engine:
+            return await getattr(engine, method)(*args, **kwargs)
+
+    return asyncio.run(call())
+
+
+def iterate_async(cod, concurrency, method, *args, **kwargs):
+    # iterates over the results of one AsyncCOD async generator method from synchronous code. The event loop only
+    # runs while the next result is awaited so generation waits while the caller, eg. a full upload queue, does
+    loop = asyncio.new_event_loop()
+    engine = AsyncCOD(cod, concurrency)
+    try:
+        loop.run_until_complete(engine.__aenter__())
+        results = getattr(engine, method)(*args, **kwargs)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(results.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(results.aclose())
+            loop.run_until_complete(engine.__aexit__(None, None, None))
+    finally:
+        loop.close()
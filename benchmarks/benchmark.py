@@ -0,0 +1,255 @@
+"""Benchmarks of the COD generation pipeline run offline against the recorded fixtures.
+
+HDX API calls are replaced by local stand-ins that sleep for a configurable latency and the
+catalogue can be multiplied to measure how each stage scales. Run from the repository root:
+
+    python -m benchmarks.benchmark --scale 1 10 100 --latency 0.01 --output benchmark.json
+"""
+import argparse
+import json
+import logging
+import tracemalloc
+from hashlib import md5
+from os.path import join
+from time import perf_counter, sleep
+from uuid import UUID
+
+from hdx.api.configuration import Configuration
+from hdx.api.locations import Locations
+from hdx.data.dataset import Dataset
+from hdx.data.organization import Organization
+from hdx.data.resource import Resource
+from hdx.data.vocabulary import Vocabulary
+from hdx.location.country import Country
+from hdx.utilities.downloader import Download
+from hdx.utilities.errors_onexit import ErrorsOnExit
+from hdx.utilities.loader import load_json
+from hdx.utilities.path import temp_dir
+from hdx.utilities.retriever import Retrieve
+from hdx.utilities.saver import save_json
+from hdx.utilities.useragent import UserAgent
+
+from cods import COD
+from dateranges import get_reference_period, parse_daterange
+from tags import TagNormalizer
+from uploader import Uploader
+
+fixtures_folder = join("tests", "fixtures")
+
+
+def setup_standins(latency):
+    UserAgent.set_global("benchmark")
+    Configuration._create(
+        hdx_read_only=True,
+        hdx_site="prod",
+        project_config_yaml=join("config", "project_configuration.yml"),
+    )
+    Country.countriesdata(use_live=False)
+    catalogue = load_json(join(fixtures_folder, "locations-all.json"))
+    locations = {x.lower() for metadata in catalogue for x in metadata["Location"]}
+    Locations.set_validlocations([{"name": x, "title": x} for x in sorted(locations)])
+    tags = {x.lower() for metadata in catalogue for x in metadata["Tags"]}
+    Vocabulary._approved_vocabulary = {
+        "tags": [{"name": x} for x in sorted(tags | {"administrative boundaries-divisions"})],
+        "id": "4e61d464-4943-4e97-973a-84673c1aaa87",
+        "name": "approved",
+    }
+    Vocabulary.set_tagsdict(
+        {
+            "administrative divisions": {
+                "Action to Take": "merge",
+                "New Tag(s)": "administrative boundaries-divisions",
+            },
+        }
+    )
+    formats = {x["Format"].lower() for metadata in catalogue for x in metadata["Resources"]}
+    Resource.set_formatsdict({x: x for x in formats | {"json", "mbtiles"}})
+
+    def read_from_hdx(name):
+        sleep(latency)
+        if name == "cod-ps-afg":
+            return Dataset.load_from_json(join(fixtures_folder, "dataset-cod-ps-afg.json"))
+        return None
+
+    def autocomplete(name):
+        sleep(latency)
+        if not name:
+            return []
+        return [{"id": str(UUID(bytes=md5(name.encode()).digest(), version=4))}]
+
+    def create_in_hdx(self, **kwargs):
+        sleep(latency)
+
+    Dataset.read_from_hdx = staticmethod(read_from_hdx)
+    Organization.autocomplete = staticmethod(autocomplete)
+    Dataset.create_in_hdx = create_in_hdx
+
+
+def scale_catalogue(folder, scale):
+    # copies keep their locations so that they still validate but get distinct titles
+    catalogue = load_json(join(fixtures_folder, "locations-all.json"))
+    scaled = list()
+    for copy in range(scale):
+        for metadata in catalogue:
+            metadata = dict(metadata)
+            if copy:
+                metadata["DatasetTitle"] = f"{metadata['DatasetTitle']} ({copy})"
+            scaled.append(metadata)
+    save_json(scaled, join(folder, "locations-all.json"))
+    for filename in ("0_do-afg.json", "1_do-afg.json"):
+        save_json(load_json(join(fixtures_folder, filename)), join(folder, filename))
+    return len(scaled)
+
+
+def measure(results, stage, function):
+    tracemalloc.start()
+    start = perf_counter()
+    count = function()
+    seconds = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results.append(
+        {
+            "stage": stage,
+            "count": count,
+            "seconds": round(seconds, 4),
+            "throughput": round(count / seconds, 1) if seconds else None,
+            "peak_mb": round(peak / 1048576, 2),
+        }
+    )
+
+
+def measure_per_dataset(results, stage, generate, datasets_metadata):
+    # peak memory above what was allocated before each dataset is generated, which is what the dataset and its
+    # resources cost while being built
+    tracemalloc.start()
+    peaks = list()
+    start = perf_counter()
+    for metadata in datasets_metadata:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        generate(metadata)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    seconds = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    count = len(peaks)
+    results.append(
+        {
+            "stage": stage,
+            "count": count,
+            "seconds": round(seconds, 4),
+            "throughput": round(count / seconds, 1) if seconds else None,
+            "peak_mb": round(peak / 1048576, 2),
+            "mean_kb_per_dataset": round(sum(peaks) / count / 1024, 1) if count else None,
+            "max_kb_per_dataset": round(max(peaks) / 1024, 1) if count else None,
+        }
+    )
+
+
+def run_benchmarks(scale, latency, workers):
+    results = list()
+    configuration = Configuration.read()
+    url = configuration["url"]
+    with temp_dir("cods-benchmark") as folder:
+        size = scale_catalogue(folder, scale)
+        with Download() as downloader:
+            retriever = Retrieve(downloader, folder, folder, folder, False, True)
+            cod = COD(retriever, ErrorsOnExit(), workers=workers)
+
+            def load():
+                # downloads and indexes the catalogue as run.py does
+                return len(cod.get_catalogue(url))
+
+            measure(results, "load", load)
+            datasets_metadata = list()
+
+            def filter():
+                datasets_metadata.extend(cod.get_datasets_metadata(url))
+                return size
+
+            measure(results, "filter", filter)
+
+            def tags():
+                normalizer = TagNormalizer()
+                for metadata in datasets_metadata:
+                    normalizer.normalize(metadata["Tags"], metadata["Theme"])
+                return len(datasets_metadata)
+
+            measure(results, "tags", tags)
+
+            def reference_period():
+                # as _generate_dataset does for each dataset
+                parse_daterange.cache_clear()
+                count = 0
+                for metadata in datasets_metadata:
+                    dateranges = [x["daterange_for_data"] for x in metadata["Resources"]]
+                    get_reference_period(dateranges)
+                    count += len(dateranges)
+                return count
+
+            measure(results, "reference_period", reference_period)
+            datasets = list()
+
+            def generate():
+                # datasets without latest resources have nothing to publish
+                generatable = [
+                    x
+                    for x in datasets_metadata
+                    if x["is_requestdata_type"] or any(y["Version"].lower() == "latest" for y in x["Resources"])
+                ]
+                datasets.extend(x for x in cod.generate_datasets(generatable) if x[0])
+                return len(generatable)
+
+            measure(results, "generate_dataset", generate)
+            catalogue = list(cod.get_datasets_metadata(url, enhanced_only=False, boundaries_only=False))
+            for stage, latest_only in (("memory_latest", True), ("memory_all_versions", False)):
+                measure_per_dataset(results, stage, lambda x: cod.generate_dataset(x, latest_only), catalogue)
+            del catalogue
+
+            def population():
+                countries = ["AFG"] * scale
+                cod.population_years.entries.clear()
+                return sum(1 for _ in cod.generate_population_datasets(countries, configuration["ps_url"]))
+
+            measure(results, "population", population)
+
+            def upload():
+                Uploader(ErrorsOnExit(), workers).upload(datasets)
+                return len(datasets)
+
+            measure(results, "upload", upload)
+    for result in results:
+        result["scale"] = scale
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", nargs="+", type=int, default=[1], help="Catalogue multipliers to run")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each HDX stand-in call takes")
+    parser.add_argument("--workers", type=int, default=1, help="Number of workers to use")
+    parser.add_argument("--output", default=None, help="JSON file in which to write the results")
+    args = parser.parse_args()
+    logging.disable(logging.ERROR)
+    setup_standins(args.latency)
+    results = list()
+    for scale in args.scale:
+        results.extend(run_benchmarks(scale, args.latency, args.workers))
+    print(
+        f"{'scale':>6} {'stage':<20} {'count':>8} {'seconds':>9} {'per second':>11} {'peak MB':>8} "
+        f"{'mean KB/dataset':>16} {'max KB/dataset':>15}"
+    )
+    for result in results:
+        print(
+            f"{result['scale']:>6} {result['stage']:<20} {result['count']:>8} {result['seconds']:>9} "
+            f"{result['throughput'] or '':>11} {result['peak_mb']:>8} {result.get('mean_kb_per_dataset') or '':>16} "
+            f"{result.get('max_kb_per_dataset') or '':>15}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
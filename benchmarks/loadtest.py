@@ -0,0 +1,134 @@
+"""End to end load test of run.py against the local ITOS and HDX stand-in.
+
+The real entry point runs in a subprocess with its ITOS urls and HDX site pointed at the stand-in and its reference
+data preloaded, so nothing leaves the machine. Arguments after -- are passed to run.py. Run from the repository root:
+
+    python -m benchmarks.loadtest --scale 10 --latency 0.02 --error_rate 0.01 --output loadtest.json -- -w 8 -uw 4
+"""
+import argparse
+import json
+import subprocess
+import sys
+from os import environ, makedirs
+from os.path import abspath, dirname, join
+from shutil import copyfile
+from time import perf_counter
+
+import hdx.location
+from hdx.utilities.loader import load_json, load_yaml
+from hdx.utilities.path import temp_dir
+from hdx.utilities.saver import save_yaml
+
+from benchmarks.standin import StandIn, fixtures_folder, hdx_key
+from startup import ReferenceData
+
+repository = dirname(dirname(abspath(__file__)))
+itos_url = "https://apps.itos.uga.edu"
+countries_file = "Countries & Territories Taxonomy MVP - C&T Taxonomy with HXL Tags.csv"
+
+
+def write_configuration(folder, url, overrides):
+    configuration = load_yaml(join(repository, "config", "project_configuration.yml"))
+    for key in ("url", "ps_url"):
+        configuration[key] = configuration[key].replace(itos_url, url)
+    configuration.update(overrides)
+    makedirs(join(folder, "config"))
+    save_yaml(configuration, join(folder, "config", "project_configuration.yml"))
+
+
+def write_reference_data(folder):
+    # what the HDX library would otherwise download from HDX and Google Sheets
+    catalogue = load_json(join(fixtures_folder, "locations-all.json"))
+    makedirs(folder)
+    copyfile(join(dirname(hdx.location.__file__), countries_file), join(folder, "countries.csv"))
+    reference_data = ReferenceData(folder)
+    locations = {x.lower() for metadata in catalogue for x in metadata["Location"]}
+    reference_data.cache.set("validlocations", [{"name": x, "title": x} for x in sorted(locations)])
+    tags = {x.lower() for metadata in catalogue for x in metadata["Tags"]}
+    tags |= {"administrative boundaries-divisions", "baseline population"}
+    reference_data.cache.set(
+        "approved_vocabulary",
+        {"tags": [{"name": x} for x in sorted(tags)], "id": "4e61d464-4943-4e97-973a-84673c1aaa87", "name": "approved"},
+    )
+    reference_data.cache.set(
+        "tags_mappings",
+        {"administrative divisions": {"Action to Take": "merge", "New Tag(s)": "administrative boundaries-divisions"}},
+    )
+    formats = {x["Format"].lower() for metadata in catalogue for x in metadata["Resources"]}
+    formats |= {"json", "mbtiles", "topojson", "geopackage"}
+    reference_data.cache.set("formats", {x: x for x in formats})
+    reference_data.cache.save()
+
+
+def run_loadtest(scale, latency, error_rate, run_args, overrides=None):
+    with StandIn(scale, latency, error_rate) as standin, temp_dir("cods-loadtest") as folder:
+        write_configuration(folder, standin.url, overrides or dict())
+        write_reference_data(join(folder, "reference_data"))
+        reports = join(folder, "reports")
+        makedirs(reports)
+        env = dict(environ, HOME=folder, HDX_URL=standin.url, HDX_KEY=hdx_key, USER_AGENT="loadtest")
+        command = [sys.executable, join(repository, "run.py"), "-rf", reports, "-rd", join(folder, "reference_data")]
+        start = perf_counter()
+        process = subprocess.run(command + run_args, cwd=folder, env=env, capture_output=True, text=True)
+        seconds = perf_counter() - start
+        try:
+            report = load_json(join(reports, "run_report.json"))
+        except FileNotFoundError:
+            report = {"values": dict()}
+        if process.returncode and not report["values"]:
+            raise RuntimeError(f"run.py failed:\n{process.stderr[-4000:]}")
+        values = report["values"]
+        datasets = values.get("datasets_uploaded", 0) + values.get("datasets_skipped", 0)
+        return {
+            "scale": scale,
+            "latency": latency,
+            "error_rate": error_rate,
+            "run_args": run_args,
+            "returncode": process.returncode,
+            "seconds": round(seconds, 3),
+            "datasets_per_second": round(datasets / seconds, 2) if seconds else None,
+            "values": values,
+            "stages": report["stages"],
+            "errors": report.get("errors", list()),
+            "uploads": report.get("uploads", list()),
+            "requests": standin.requests,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=int, default=1, help="Catalogue multiplier")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each stand-in request takes")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of stand-in requests that fail")
+    parser.add_argument(
+        "--set", action="append", default=list(), help="Project configuration override eg. upload_rate=0"
+    )
+    parser.add_argument("--output", default=None, help="JSON file in which to write the results")
+    parser.add_argument("run_args", nargs=argparse.REMAINDER, help="Arguments after -- are passed to run.py")
+    args = parser.parse_args()
+    run_args = args.run_args
+    if run_args[:1] == ["--"]:
+        run_args = run_args[1:]
+    overrides = dict()
+    for override in args.set:
+        key, value = override.split("=", 1)
+        try:
+            overrides[key] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[key] = value
+    result = run_loadtest(args.scale, args.latency, args.error_rate, run_args, overrides)
+    values = result["values"]
+    print(f"{' '.join(['run.py', *run_args])} exited with {result['returncode']} in {result['seconds']}s")
+    for name in ("datasets_in_catalogue", "datasets_generated", "datasets_uploaded", "datasets_skipped"):
+        print(f"{name:<22} {values.get(name, '')}")
+    print(f"{'datasets per second':<22} {result['datasets_per_second']}")
+    print(f"{'errors':<22} {len(result['errors'])}")
+    for endpoint, counts in sorted(result["requests"].items()):
+        print(f"{endpoint:<30} {', '.join(f'{status}: {count}' for status, count in sorted(counts.items()))}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
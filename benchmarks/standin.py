@@ -0,0 +1,257 @@
+"""Local stand-in for the ITOS CODV2API and the subset of the HDX action API that the scraper uses.
+
+The catalogue and population services are served from the test fixtures, the catalogue multiplied by *scale*. HDX
+datasets live in memory, seeded with a population dataset for every country in the catalogue and a boundary dataset
+for every boundary dataset in it. Every request waits *latency* seconds and fails with a 503 with probability
+*error_rate*. Run on its own with:
+
+    python -m benchmarks.standin --port 8000 --scale 10 --latency 0.02 --error_rate 0.01
+"""
+import argparse
+import json
+import logging
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join
+from random import Random
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import parse_qsl, urlsplit
+from uuid import UUID
+
+from hdx.utilities.loader import load_json
+
+from cods import COD
+
+logger = logging.getLogger(__name__)
+
+fixtures_folder = join("tests", "fixtures")
+itos_prefix = "/CODV2API/api/v1"
+population_levels = 2
+hdx_key = "00000000-0000-4000-8000-000000000000"
+
+
+def get_id(value):
+    return str(UUID(bytes=md5(value.encode()).digest(), version=4))
+
+
+def scale_catalogue(catalogue, scale):
+    # copies keep their locations so that they still validate but get distinct titles. Dataset names come from the
+    # theme and location so the copies of a dataset update the same HDX dataset
+    scaled = list()
+    for copy in range(scale):
+        for metadata in catalogue:
+            if copy:
+                metadata = dict(metadata)
+                metadata["DatasetTitle"] = f"{metadata['DatasetTitle']} ({copy})"
+            scaled.append(metadata)
+    return scaled
+
+
+class StandIn:
+    def __init__(self, scale=1, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = Random(seed)
+        self.lock = Lock()
+        self.requests = dict()
+        catalogue = load_json(join(fixtures_folder, "locations-all.json"))
+        self.isos = sorted({x["Location"][0].upper() for x in catalogue if x["Location"]})
+        self.catalogue = json.dumps(scale_catalogue(catalogue, scale)).encode()
+        self.population = [load_json(join(fixtures_folder, f"{adm}_do-afg.json")) for adm in range(population_levels)]
+        self.datasets = dict()
+        template = load_json(join(fixtures_folder, "dataset-cod-ps-afg.json"))
+        for iso in self.isos:
+            self.seed(template, f"cod-ps-{iso.lower()}")
+        # boundary datasets are already on HDX as they are in production, so that they are updated rather than created
+        template = load_json(join(fixtures_folder, "dataset-cod-ab-afg.json"))
+        for metadata in catalogue:
+            if metadata["Theme"] in ("COD_AB", "COD_EM"):
+                self.seed(template, COD.get_dataset_name(metadata), metadata["DatasetTitle"])
+        self.httpd = None
+        self.thread = None
+
+    def seed(self, template, name, title=None):
+        dataset = json.loads(json.dumps(template).replace(template["name"], name))
+        dataset["id"] = get_id(name)
+        if title:
+            dataset["title"] = title
+        for resource in dataset["resources"]:
+            resource["id"] = get_id(f"{name} {resource['name']}")
+            resource["package_id"] = dataset["id"]
+        self.datasets[name] = dataset
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def start(self, port=0):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                standin.handle(self, dict(parse_qsl(urlsplit(self.path).query)))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    parameters = json.loads(body or b"{}")
+                else:
+                    parameters = dict(parse_qsl(body.decode()))
+                standin.handle(self, parameters)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def count(self, endpoint, status):
+        with self.lock:
+            counts = self.requests.setdefault(endpoint, dict())
+            counts[status] = counts.get(status, 0) + 1
+
+    def fails(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def handle(self, request, parameters):
+        path = urlsplit(request.path).path
+        if path.startswith(itos_prefix):
+            endpoint = "itos_population" if "/cod-ps/" in path else "itos_catalogue"
+        else:
+            endpoint = path.rstrip("/").split("/")[-1]
+        if self.latency:
+            sleep(self.latency)
+        if self.fails():
+            status, body = 503, {"success": False, "error": {"message": "Service unavailable"}}
+        elif path.startswith(itos_prefix):
+            status, body = self.handle_itos(path)
+        else:
+            status, body = self.handle_action(endpoint, parameters)
+        self.count(endpoint, status)
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        try:
+            request.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):  # the client gave up, eg. on a probe it cancelled
+            pass
+
+    def handle_itos(self, path):
+        if path == f"{itos_prefix}/Locations/all":
+            return 200, self.catalogue
+        # population lookups are .../cod-ps/lookup/Get/<adm>/do/<iso>
+        parts = path.split("/")
+        adm = int(parts[-3])
+        if parts[-1].upper() not in self.isos or adm >= population_levels:
+            return 404, {"status": "Not found"}
+        return 200, self.population[adm]
+
+    def handle_action(self, action, parameters):
+        # responses are in the form ckanapi expects from CKAN
+        handler = getattr(self, f"action_{action}", None)
+        if handler is None:
+            return 400, {"success": False, "error": {"__type": "Validation Error", "message": f"Unknown {action}"}}
+        try:
+            return 200, {"success": True, "result": handler(parameters)}
+        except (KeyError, StopIteration) as ex:
+            return 404, {"success": False, "error": {"__type": "Not Found Error", "message": f"Not found: {ex}"}}
+
+    def action_package_show(self, parameters):
+        with self.lock:
+            return self.datasets[parameters["id"]]
+
+    def action_package_search(self, parameters):
+        start = int(parameters.get("start", 0))
+        rows = int(parameters.get("rows", 1000))
+        with self.lock:
+            results = [x for x in self.datasets.values() if x["name"].startswith(("cod-ab-", "cod-em-", "cod-ps-"))]
+        return {"count": len(results), "results": results[start : start + rows]}
+
+    def action_organization_autocomplete(self, parameters):
+        name = parameters.get("q")
+        if not name:
+            return list()
+        return [{"id": get_id(name), "name": name.lower().replace(" ", "-"), "title": name}]
+
+    def action_package_create(self, parameters):
+        dataset = dict(parameters)
+        dataset["id"] = get_id(dataset["name"])
+        for resource in dataset.get("resources", list()):
+            resource["id"] = get_id(f"{dataset['name']} {resource['name']}")
+            resource["package_id"] = dataset["id"]
+        with self.lock:
+            self.datasets[dataset["name"]] = dataset
+        return dataset
+
+    def action_package_update(self, parameters):
+        with self.lock:
+            existing = self.datasets.get(parameters.get("name")) or self.datasets[parameters["id"]]
+        return self.action_package_create({**existing, **parameters})
+
+    def action_package_revise(self, parameters):
+        # match, filter and update arrive as JSON strings. Only the filters the HDX library sends are supported:
+        # removing top level keys and trailing resources
+        match = json.loads(parameters["match"])
+        with self.lock:
+            existing = next(x for x in self.datasets.values() if x["id"] == match.get("id") or x["name"] == match.get("name"))
+        dataset = {**existing, **json.loads(parameters.get("update", "{}"))}
+        for key in json.loads(parameters.get("filter", "[]")):
+            key = key.lstrip("-")
+            if key.startswith("resources__"):
+                del dataset["resources"][int(key.split("__")[1]) :]
+            else:
+                dataset.pop(key, None)
+        return {"package": self.action_package_create(dataset)}
+
+    def action_package_resource_reorder(self, parameters):
+        with self.lock:
+            dataset = next(x for x in self.datasets.values() if x["id"] == parameters["id"])
+            resources = {x["id"]: x for x in dataset["resources"]}
+            dataset["resources"] = [resources[x] for x in parameters["order"]]
+        return {"id": dataset["id"], "order": parameters["order"]}
+
+    def action_package_create_default_resource_views(self, parameters):
+        return list()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--scale", type=int, default=1, help="Catalogue multiplier")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each request takes")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests that fail with a 503")
+    args = parser.parse_args()
+    standin = StandIn(args.scale, args.latency, args.error_rate)
+    url = standin.start(args.port)
+    print(f"Serving ITOS at {url}{itos_prefix} and HDX at {url}")
+    try:
+        standin.thread.join()
+    except KeyboardInterrupt:
+        standin.stop()
+
+
+if __name__ == "__main__":
+    main()
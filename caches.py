@@ -0,0 +1,192 @@
+import logging
+from hashlib import sha256
+from json import dumps
+from os import listdir, makedirs, remove, replace
+from os.path import basename, exists, join
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import time
+
+from hdx.utilities.loader import load_json
+from hdx.utilities.saver import save_json
+
+logger = logging.getLogger(__name__)
+
+
+class PersistentCache:
+    def __init__(self, path=None, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.entries = dict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        if path and exists(path):
+            self.load()
+
+    def load(self):
+        now = time()
+        for key, entry in load_json(self.path).items():
+            if self.ttl and now - entry["timestamp"] > self.ttl:
+                continue
+            self.entries[key] = entry
+        logger.info(f"Loaded {len(self.entries)} cached entries from {self.path}")
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            save_json(self.entries, self.path)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            return True, entry["value"]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = {"value": value, "timestamp": time()}
+
+
+class HTTPCache:
+    def __init__(self, folder, ttl=None, max_bytes=None):
+        # bodies are stored once per content hash in blobs, with an index from url and parameters to the
+        # blob, the validators (ETag and Last-Modified) and when it was last validated and accessed
+        self.folder = folder
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.index_path = join(folder, "index.json")
+        self.entries = dict()
+        self.pins = dict()
+        self.lock = Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        makedirs(join(folder, "blobs"), exist_ok=True)
+        if exists(self.index_path):
+            for key, entry in load_json(self.index_path).items():
+                if exists(self.get_blob_path(entry["blob"])):
+                    self.entries[key] = entry
+            logger.info(f"Loaded {len(self.entries)} cached responses from {folder}")
+        self.sweep()
+
+    @staticmethod
+    def get_key(url, parameters=None):
+        return sha256(dumps([url, parameters or dict()], sort_keys=True).encode()).hexdigest()
+
+    def get_blob_path(self, blob):
+        return join(self.folder, "blobs", blob)
+
+    def fetch(self, downloader, url, parameters=None, timeout=None):
+        # returns the path of the body and the number of bytes transferred to get it. The body is pinned so that
+        # eviction by another thread does not delete it until the caller has read it and called release
+        key = self.get_key(url, parameters)
+        now = time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl and now - entry["validated"] <= self.ttl:
+                self.hits += 1
+                entry["accessed"] = now
+                return self.pin(entry["blob"]), 0
+            if entry is not None:
+                entry = dict(entry)
+        headers = dict()
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        response = downloader.setup(url, parameters=parameters, timeout=timeout, headers=headers or None)
+        if entry is not None and headers and response.status_code == 304:
+            response.close()
+            with self.lock:
+                current = self.entries.get(key)
+                if current is not None and current["blob"] == entry["blob"]:
+                    self.revalidated += 1
+                    current["accessed"] = now
+                    current["validated"] = now
+                    return self.pin(current["blob"]), 0
+            # the response was evicted while it was being revalidated so its body may be gone
+            response = downloader.setup(url, parameters=parameters, timeout=timeout)
+        blob, size = self.write_blob(response)
+        with self.lock:
+            self.misses += 1
+            previous = self.entries.get(key)
+            self.entries[key] = {
+                "url": url,
+                "blob": blob,
+                "size": size,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "validated": now,
+                "accessed": now,
+            }
+            if previous is not None and not self.is_referenced(previous["blob"]):  # the content changed
+                self.remove_blob(previous["blob"])
+            self.evict()
+            return self.pin(blob), size
+
+    def pin(self, blob):
+        self.pins[blob] = self.pins.get(blob, 0) + 1
+        return self.get_blob_path(blob)
+
+    def release(self, path):
+        # unpins a body returned by fetch, deleting it if it was evicted or replaced while pinned
+        blob = basename(path)
+        with self.lock:
+            self.pins[blob] -= 1
+            if self.pins[blob] == 0:
+                del self.pins[blob]
+                if not self.is_referenced(blob):
+                    self.remove_blob(blob)
+
+    def is_referenced(self, blob):
+        return any(entry["blob"] == blob for entry in self.entries.values())
+
+    def remove_blob(self, blob):
+        # a pinned blob is deleted by release instead
+        if blob not in self.pins:
+            remove(self.get_blob_path(blob))
+
+    def write_blob(self, response):
+        digest = sha256()
+        size = 0
+        with NamedTemporaryFile(dir=join(self.folder, "blobs"), delete=False) as f:
+            for chunk in response.iter_content(chunk_size=10240):
+                digest.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+        blob = digest.hexdigest()
+        replace(f.name, self.get_blob_path(blob))
+        return blob, size
+
+    def evict(self):
+        # least recently accessed responses are dropped until the blobs fit in max_bytes
+        if not self.max_bytes:
+            return
+        sizes = {entry["blob"]: entry["size"] for entry in self.entries.values()}
+        total = sum(sizes.values())
+        for key, entry in sorted(self.entries.items(), key=lambda x: x[1]["accessed"]):
+            if total <= self.max_bytes or len(self.entries) == 1:
+                break
+            del self.entries[key]
+            blob = entry["blob"]
+            if self.is_referenced(blob):
+                continue
+            total -= sizes[blob]
+            self.remove_blob(blob)
+
+    def sweep(self):
+        # deletes blobs left behind by earlier runs, eg. ones that were interrupted while writing or releasing them
+        blobs = {entry["blob"] for entry in self.entries.values()}
+        for blob in listdir(join(self.folder, "blobs")):
+            if blob not in blobs:
+                remove(self.get_blob_path(blob))
+
+    def save(self):
+        with self.lock:
+            save_json(self.entries, self.index_path)
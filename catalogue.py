@@ -0,0 +1,144 @@
+import logging
+from hashlib import sha256
+from os.path import exists
+
+from hdx.utilities.loader import load_json
+from hdx.utilities.saver import save_json
+
+logger = logging.getLogger(__name__)
+
+# the fields of Locations/all records that are kept, which are only those used to select and generate datasets
+record_fields = (
+    "DatasetTitle",
+    "DatasetDescription",
+    "FrequencyUpdates",
+    "DatasetDate",
+    "Resources",
+    "Source",
+    "Contributor",
+    "Location",
+    "Theme",
+    "License",
+    "License_Other",
+    "Methodology",
+    "Methodology_Other",
+    "Caveats",
+    "is_requestdata_type",
+    "is_enhanced_cod",
+    "file_types",
+    "field_names",
+    "Tags",
+    "Total",
+    "num_of_rows",
+)
+resource_fields = (
+    "Format",
+    "ResourceItemTitle",
+    "ResourceItemDescription",
+    "DownloadURL",
+    "Version",
+    "daterange_for_data",
+)
+
+
+def get_digest(path):
+    digest = sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1048576), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Catalogue:
+    def __init__(self, digest=None):
+        # records are kept as lists of values in the order of record_fields (missing fields are stored as a
+        # one-element list so that they can be told apart from null values) and are indexed by position
+        self.digest = digest
+        self.records = list()
+        self.indexes = {"iso3": dict(), "theme": dict(), "enhanced": dict(), "version": dict()}
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, metadata):
+        row = list()
+        for field in record_fields:
+            if field not in metadata:
+                row.append([None])
+            elif field == "Resources":
+                row.append([[resource.get(x) for x in resource_fields] for resource in metadata[field]])
+            else:
+                row.append(metadata[field])
+        position = len(self.records)
+        self.records.append(row)
+        location = metadata.get("Location")
+        if location:
+            self.indexes["iso3"].setdefault(location[0].upper(), list()).append(position)
+        self.indexes["theme"].setdefault(metadata.get("Theme"), list()).append(position)
+        self.indexes["enhanced"].setdefault(str(bool(metadata.get("is_enhanced_cod"))), list()).append(position)
+        versions = {resource.get("Version") for resource in metadata.get("Resources", list())}
+        for version in sorted(versions, key=str):
+            self.indexes["version"].setdefault(version, list()).append(position)
+
+    def get(self, position):
+        metadata = dict()
+        for field, value in zip(record_fields, self.records[position]):
+            if value == [None]:
+                continue
+            if field == "Resources":
+                value = [dict(zip(resource_fields, resource)) for resource in value]
+            metadata[field] = value
+        return metadata
+
+    def get_field(self, position, field):
+        return self.records[position][record_fields.index(field)]
+
+    def select(self, countries=None, themes=None, enhanced=None, version=None):
+        # intersects the indexes that apply, returning positions in catalogue order
+        selected = None
+        for index, keys in (
+            ("iso3", countries),
+            ("theme", themes),
+            ("enhanced", None if enhanced is None else [str(enhanced)]),
+            ("version", None if version is None else [version]),
+        ):
+            if keys is None:
+                continue
+            positions = set()
+            for key in keys:
+                positions.update(self.indexes[index].get(key, list()))
+            if selected is None:
+                selected = positions
+            else:
+                selected &= positions
+        if selected is None:
+            return list(range(len(self.records)))
+        return sorted(selected)
+
+    def save(self, path):
+        save_json(
+            {
+                "digest": self.digest,
+                "record_fields": record_fields,
+                "resource_fields": resource_fields,
+                "records": self.records,
+                "indexes": self.indexes,
+            },
+            path,
+        )
+
+    @classmethod
+    def load(cls, path, digest):
+        # returns None if the file was built from another download or with other fields
+        if not path or not exists(path):
+            return None
+        saved = load_json(path)
+        if saved["digest"] != digest:
+            return None
+        if tuple(saved["record_fields"]) != record_fields or tuple(saved["resource_fields"]) != resource_fields:
+            return None
+        catalogue = cls(digest)
+        catalogue.records = saved["records"]
+        catalogue.indexes = saved["indexes"]
+        logger.info(f"Loaded catalogue of {len(catalogue)} records from {path}")
+        return catalogue
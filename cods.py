@@ -1,65 +1,266 @@
 import logging
+import threading
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+import ijson
 from slugify import slugify
 
 from hdx.data.dataset import Dataset
-from hdx.data.date_helper import DateHelper
 from hdx.data.hdxobject import HDXError
-from hdx.data.organization import Organization
 from hdx.data.resource import Resource
 from hdx.location.country import Country
+from hdx.utilities.downloader import Download
 from hdx.utilities.retriever import DownloadError
 from hdx.utilities.uuid import get_uuid
+from requests.exceptions import ConnectionError, Timeout
+
+from caches import PersistentCache
+from catalogue import Catalogue, get_digest
+from dateranges import get_reference_period, parse_daterange
+from hdx_datasets import DatasetIndex
+from instrumentation import run_report
+from organizations import OrganizationResolver
+from resilience import CircuitOpenError, Upstream, is_transient
+from sharding import get_batch_id
+from tags import TagNormalizer
 
 logger = logging.getLogger(__name__)
 
 
 class COD:
-    def __init__(self, retriever, errors):
+    def __init__(
+        self,
+        retriever,
+        errors,
+        *,
+        workers=1,
+        organizations=None,
+        hdx_datasets=None,
+        probes=1,
+        population_years=None,
+        run_id=None,
+        catalogue_cache=None,
+        max_resources=None,
+        resilience=None,
+    ):
         self.retriever = retriever
+        self.run_id = run_id
+        self.catalogue_cache = catalogue_cache
+        self.max_resources = max_resources
+        if resilience is None:
+            resilience = dict()
+        self.upstreams = {
+            "catalogue": Upstream("itos_catalogue", **resilience),
+            "population": Upstream("itos_population", **resilience),
+        }
+        self.catalogues = dict()
+        self.tags = TagNormalizer()
         self.batches_by_org = dict()
         self.errors = errors
+        self.workers = workers
+        self.probes = probes
+        self.local = threading.local()
+        if organizations is None:
+            organizations = OrganizationResolver()
+        self.organizations = organizations
+        if hdx_datasets is None:
+            hdx_datasets = DatasetIndex()
+        self.hdx_datasets = hdx_datasets
+        if population_years is None:
+            population_years = PersistentCache()
+        self.population_years = population_years
+
+    def get_retriever(self):
+        # a Download object keeps its last response so each thread gets its own one sharing the session
+        if threading.current_thread() is threading.main_thread():
+            return self.retriever
+        retriever = getattr(self.local, "retriever", None)
+        if retriever is None:
+            retriever = self.retriever.clone(Download(session=self.retriever.downloader.session))
+            self.local.retriever = retriever
+        return retriever
+
+    def map(self, function, iterable):
+        if self.workers > 1:
+            return self.map_concurrently(function, iterable)
+        return map(function, iterable)
+
+    def map_concurrently(self, function, iterable):
+        # results are yielded in input order as soon as they are ready with at most twice as many in flight as
+        # there are workers, so that generated datasets can be handed on without holding all of them
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            yield from self.map_ahead(executor, function, iterable, self.workers * 2)
+
+    @staticmethod
+    def map_ahead(executor, function, iterable, window):
+        # yields results in input order with at most window calls submitted, cancelling those not yet started if
+        # the caller stops iterating
+        futures = deque()
+        try:
+            for item in iterable:
+                futures.append(executor.submit(function, item))
+                if len(futures) == window:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def get_batch(self, organization_id):
+        batch = self.batches_by_org.get(organization_id)
+        if batch is None:
+            if self.run_id:
+                batch = get_batch_id(self.run_id, organization_id)
+            else:
+                batch = get_uuid()
+            self.batches_by_org[organization_id] = batch
+        return batch
 
     def get_dataset_titles(self, url, countries=None):
-        results = self.retriever.download_json(url)
-        if countries is None:
-            return [x["DatasetTitle"] for x in results]
-        return [x["DatasetTitle"] for x in results if len(x["Location"]) > 0 and x["Location"][0].upper() in countries]
-
-    def get_datasets_metadata(self, url, countries=None, enhanced_only=True, boundaries_only=True):
-        results = self.retriever.download_json(url)
-        if enhanced_only:
-            results = [x for x in results if x.get("is_enhanced_cod")]
-        if boundaries_only:
-            results = [x for x in results if x.get("Theme") in ["COD_AB", "COD_EM"]]
-        if countries is None:
-            return results
-        return [x for x in results if len(x["Location"]) > 0 and x["Location"][0].upper() in countries]
+        catalogue = self.get_catalogue(url)
+        return [catalogue.get_field(i, "DatasetTitle") for i in catalogue.select(countries)]
+
+    def get_datasets_metadata(self, url, countries=None, enhanced_only=True, boundaries_only=True, path=None):
+        # records are only rebuilt from the compact catalogue as they are consumed
+        catalogue = self.get_catalogue(url, path)
+        with run_report.stage("filter"):
+            positions = catalogue.select(
+                countries,
+                themes=["COD_AB", "COD_EM"] if boundaries_only else None,
+                enhanced=True if enhanced_only else None,
+            )
+        return (catalogue.get(i) for i in positions)
+
+    def download_catalogue(self, url):
+        filename, _ = self.retriever.get_filename(url, None, ("json",))
+        with run_report.stage("catalogue"):
+            return self.upstreams["catalogue"].call(self.retriever.download_file, url, filename=filename)
+
+    def get_catalogue(self, url, path=None):
+        # the catalogue is built once per download and kept in catalogue_cache, if given, from where it is
+        # loaded on the next run as long as the download has not changed
+        catalogue = self.catalogues.get(url)
+        if catalogue is not None:
+            return catalogue
+        if path is None:
+            path = self.download_catalogue(url)
+        with run_report.stage("catalogue_index"):
+            digest = get_digest(path)
+            catalogue = Catalogue.load(self.catalogue_cache, digest)
+            if catalogue is None:
+                catalogue = Catalogue(digest)
+                for x in self.iterate_catalogue(path):
+                    catalogue.add(x)
+                if self.catalogue_cache:
+                    catalogue.save(self.catalogue_cache)
+        self.catalogues[url] = catalogue
+        return catalogue
+
+    @staticmethod
+    def iterate_catalogue(path):
+        with open(path, "rb") as f:
+            yield from ijson.items(f, "item", use_float=True)
 
     def generate_dataset(self, metadata, latest_only=True):
-        error_count = len(self.errors.errors)
+        return self.add_generated_dataset(*self._generate_dataset(metadata, latest_only))
+
+    def generate_datasets(self, datasets_metadata, latest_only=True):
+        # datasets are generated concurrently but errors and batches are resolved in input order so
+        # that the output is the same as generating them one by one
+        generate = partial(self._generate_dataset, latest_only=latest_only)
+        for result in self.map(generate, datasets_metadata):
+            yield self.add_generated_dataset(*result)
+
+    def add_generated_dataset(self, dataset, organization_id, errors):
+        for error in errors:
+            self.errors.add(error)
+        batch = None
+        if organization_id:
+            batch = self.get_batch(organization_id)
+        if errors:  # if errors were generated, do not push dataset to HDX
+            return None, None
+        return dataset, batch
+
+    @staticmethod
+    def get_dataset_name(metadata):
+        theme = metadata["Theme"]
+        location = metadata["Location"]
+        if theme == "COD_AB" and (location == ["MMR"] or location == ["mmr"]):
+            name = slugify(metadata["DatasetTitle"])
+        else:
+            name = slugify(f"{theme} {' '.join(location)}")
+        return name[:99]
+
+    def iterate_resources_metadata(self, metadata, latest_only=True):
+        # all versions are grouped with the latest first and then historical versions, which are the dateranges they
+        # were current for, newest first. A download url is only published once, for its newest version
+        resources_metadata = metadata["Resources"]
+        if latest_only:
+            resources_metadata = (x for x in resources_metadata if x["Version"].lower() == "latest")
+        else:
+            latest = list()
+            versions = dict()
+            for resource_metadata in resources_metadata:
+                version = resource_metadata["Version"]
+                if version.lower() == "latest":
+                    latest.append(resource_metadata)
+                else:
+                    versions.setdefault(version, list()).append(resource_metadata)
+            resources_metadata = chain(latest, *(versions[x] for x in sorted(versions, reverse=True)))
+        urls = set()
+        count = 0
+        for resource_metadata in resources_metadata:
+            if not latest_only:
+                url = resource_metadata["DownloadURL"]
+                if url in urls:
+                    run_report.add("resources_deduplicated")
+                    continue
+                urls.add(url)
+            if self.max_resources and count == self.max_resources:
+                logger.warning(f"Dataset: {metadata['DatasetTitle']} has more than {self.max_resources} resources")
+                run_report.add("datasets_capped")
+                return
+            count += 1
+            yield resource_metadata
+
+    @staticmethod
+    def get_resource_name(resource_metadata):
+        # resources of historical versions share titles with the latest ones so are suffixed with their start date
+        name = resource_metadata["ResourceItemTitle"]
+        version = resource_metadata["Version"]
+        if version.lower() == "latest":
+            return name
+        if version.startswith("["):
+            version = parse_daterange(version)[0].strftime("%Y-%m-%d")
+        return f"{name} ({version})"
+
+    @run_report.timed("generate_dataset")
+    def _generate_dataset(self, metadata, latest_only):
+        errors = list()
         title = metadata["DatasetTitle"]
         is_requestdata_type = metadata["is_requestdata_type"]
         if not is_requestdata_type:
             if metadata["Total"] == 0:
-                self.errors.add(f"Ignoring dataset: {title} which has no resources!")
-                return None, None
+                errors.append(f"Ignoring dataset: {title} which has no resources!")
+                return None, None, errors
         if not metadata["Source"]:
-            self.errors.add(f"Dataset: {title} has no source!")
+            errors.append(f"Dataset: {title} has no source!")
         logger.info(f"Creating dataset: {title}")
         cod_level = "cod-standard"
         if metadata["is_enhanced_cod"]:
             cod_level = "cod-enhanced"
         theme = metadata["Theme"]
         if not theme:
-            self.errors.add(f"Dataset: {title} has no theme!")
+            errors.append(f"Dataset: {title} has no theme!")
         location = metadata["Location"]
-        if theme == "COD_AB" and (location == ["MMR"] or location == ["mmr"]):
-            name = slugify(title)
-        else:
-            name = slugify(f"{theme} {' '.join(location)}")
+        name = self.get_dataset_name(metadata)
         dataset = Dataset(
             {
-                "name": name[:99],
+                "name": name,
                 "title": title,
                 "notes": metadata["DatasetDescription"],
                 "dataset_source": metadata["Source"],
@@ -72,15 +273,28 @@ class COD:
                 "cod_level": cod_level,
             }
         )
+        hdx_dataset = None
+        private = None
         try:
-            hdx_dataset = Dataset.read_from_hdx(name)
-        except HDXError:
+            hdx_dataset = self.hdx_datasets.read(name)
+            # new datasets are public and existing ones keep their visibility. If the read failed it is left unset so
+            # that the upload fails rather than changing it
+            private = hdx_dataset.get("private", False) if hdx_dataset else False
+        except CircuitOpenError as ex:
+            errors.append(self.get_read_error(name, ex))
+            return None, None, errors
+        except HDXError as ex:
+            if is_transient(ex):  # the dataset is not published rather than losing its customviz
+                errors.append(self.get_read_error(name, ex))
+                return None, None, errors
             logger.error(f"Could not read dataset {name} from HDX")
         customviz = None
         if hdx_dataset:
             customviz = hdx_dataset.get("customviz")
         if customviz:
             dataset["customviz"] = customviz
+        if private is not None:
+            dataset["private"] = private
         licence = metadata["License"]
         if licence == "Other":
             dataset["license_id"] = "hdx-other"
@@ -90,48 +304,36 @@ class COD:
         methodology = metadata["Methodology"]
         methodology_other = metadata["Methodology_Other"]
         if methodology == "" and methodology_other == "":
-            self.errors.add(f"Dataset: {dataset['name']} has no methodology!")
+            errors.append(f"Dataset: {dataset['name']} has no methodology!")
         if methodology == "Other":
             dataset["methodology"] = "Other"
             if not methodology_other or methodology_other == "":
-                self.errors.add(f"Dataset: {dataset['name']} has no other methodology!")
+                errors.append(f"Dataset: {dataset['name']} has no other methodology!")
             if methodology_other:
                 dataset["methodology_other"] = methodology_other
         else:
             dataset["methodology"] = methodology
         dataset.set_maintainer("196196be-6037-4488-8b71-d786adf4c081")
-        organization = Organization.autocomplete(metadata["Contributor"])
-        if len(organization) == 0:
-            organization = Organization.autocomplete(metadata["Contributor"].replace(" ", "-"))
-        organization_id = None
-        batch = None
         try:
-            organization_id = organization[0]["id"]
-        except IndexError:
-            self.errors.add(f"Dataset: {dataset['name']} has an invalid organization {metadata['Contributor']}!")
+            organization_id = self.organizations.resolve(metadata["Contributor"])
+        except (CircuitOpenError, HDXError) as ex:
+            errors.append(f"Dataset: {dataset['name']} organization could not be looked up in HDX. Error: {ex}")
+            return None, None, errors
         if organization_id:
             dataset.set_organization(organization_id)
-            batch = self.batches_by_org.get(organization_id, get_uuid())
-            self.batches_by_org[organization_id] = batch
+        else:
+            errors.append(f"Dataset: {dataset['name']} has an invalid organization {metadata['Contributor']}!")
         dataset.set_subnational(True)
         try:
             dataset.add_country_locations(location)
         except HDXError:
-            self.errors.add(f"Dataset: {dataset['name']} has an invalid location {location}!")
+            errors.append(f"Dataset: {dataset['name']} has an invalid location {location}!")
         tags = [t for t in metadata["Tags"] if t.replace(" ", "") != "commonoperationaldataset-cod"]
-        dataset.add_tags(tags)
-        if len(dataset.get_tags()) < len(tags):
-            self.errors.add(f"Dataset: {dataset['name']} has invalid tags!")
-        if theme in ["COD_AB", "COD_EM"]:
-            if "baseline population" in dataset.get_tags():
-                dataset.remove_tag("baseline population")
-            if "administrative boundaries-divisions" not in dataset.get_tags():
-                dataset.add_tag("administrative boundaries-divisions")
-        if theme == "COD_PS":
-            if "baseline population" not in dataset.get_tags():
-                dataset.add_tag("baseline population")
-            if "administrative boundaries-divisions" in dataset.get_tags():
-                dataset.remove_tag("administrative boundaries-divisions")
+        tags, invalid = self.tags.get_tags(tags, theme)
+        if tags:
+            dataset["tags"] = tags
+        if invalid:
+            errors.append(f"Dataset: {dataset['name']} has invalid tags!")
         if is_requestdata_type:
             dataset["dataset_date"] = metadata["DatasetDate"]
             dataset["is_requestdata_type"] = True
@@ -141,100 +343,180 @@ class COD:
             if num_of_rows:
                 dataset["num_of_rows"] = num_of_rows
         else:
-            startdate = None
-            enddate = None
-            ongoing = False
+            # the memory a dataset takes is bounded by max_resources, which caps the resources built for it
+            dateranges = dict()
             resources = list()
-            for resource_metadata in metadata["Resources"]:
-                version = resource_metadata["Version"]
-                if latest_only and version.lower() != "latest":
-                    continue
+            for resource_metadata in self.iterate_resources_metadata(metadata, latest_only):
                 resource_daterange = resource_metadata["daterange_for_data"]
                 format = resource_metadata["Format"]
                 if format == "VectorTile":
                     format = "MBTiles"
                     logger.error(f"Dataset: {dataset['name']} is using file type VectorTile instead of MBTiles")
                 resourcedata = {
-                    "name": resource_metadata["ResourceItemTitle"],
+                    "name": self.get_resource_name(resource_metadata),
                     "description": resource_metadata["ResourceItemDescription"],
                     "url": resource_metadata["DownloadURL"],
                     "format": format,
                     "daterange_for_data": resource_daterange,
                 }
-                date_info = DateHelper.get_reference_period_info(resource_daterange)
-                resource_startdate = date_info["startdate"]
-                resource_enddate = date_info["enddate"]
-                resource_ongoing = date_info["ongoing"]
-                if startdate is None or resource_startdate < startdate:
-                    startdate = resource_startdate
-                if enddate is None or resource_enddate > enddate:
-                    enddate = resource_enddate
-                    ongoing = resource_ongoing
-                resource = Resource(resourcedata)
-                resources.append(resource)
-            if ongoing:
-                enddate = "*"
+                dateranges[resource_daterange] = None
+                resources.append(Resource(resourcedata))
             try:
                 dataset.add_update_resources(resources)
             except HDXError as ex:
-                self.errors.add(f"Dataset: {dataset['name']} resources could not be added. Error: {ex}")
-            dataset.set_reference_period(startdate, enddate, ongoing)
-        if len(self.errors.errors) > error_count:  # if more errors were generated, do not push dataset to HDX
-            return None, None
+                errors.append(f"Dataset: {dataset['name']} resources could not be added. Error: {ex}")
+            if dateranges:
+                dataset.set_reference_period(*get_reference_period(dateranges))
+            else:
+                errors.append(f"Dataset: {dataset['name']} has no resources to publish!")
+        return dataset, organization_id, errors
+
+    @staticmethod
+    def get_population_urls(iso, url):
+        return [url.replace("/iso", f"/{iso}").replace("/adm/", f"/{adm}/") for adm in range(0, 5)]
+
+    def get_cached_population_year(self, url, adm):
+        return self.population_years.get(f"{url}#{adm}")
+
+    @staticmethod
+    def get_failed_population_year(ex, transient_errors=(ConnectionError, Timeout)):
+        # a probe that failed other than transiently means that the admin level is missing. Once the retries of a
+        # transient failure are exhausted whether it exists is unknown, so the error is raised
+        if is_transient(ex, transient_errors):
+            raise ex
+        return False, None
+
+    def set_population_year(self, url, adm, year):
+        # returns whether the admin level exists and its year from the probe response, caching the result
+        if len(year) == 1 and year[0].get("status"):
+            result = False, None
         else:
-            return dataset, batch
+            result = True, year.get("Year")
+        self.population_years.set(f"{url}#{adm}", result)
+        return result
+
+    @staticmethod
+    def add_population_year(years, urls, adm, exists, year):
+        # returns whether to carry on, as admin levels are only probed up to the first missing one
+        if not exists:
+            return False
+        if year:
+            years[adm] = (urls[adm], year)
+        return True
+
+    def get_population_year(self, url, adm):
+        # returns whether the admin level exists and its year, caching the result unless the download failed
+        found, result = self.get_cached_population_year(url, adm)
+        if found:
+            return result
+        try:
+            with run_report.stage("population_probe"):
+                year = self.upstreams["population"].call(self.get_retriever().download_json, url, file_prefix=str(adm))
+        except (DownloadError, FileNotFoundError) as ex:
+            return self.get_failed_population_year(ex)
+        return self.set_population_year(url, adm, year)
+
+    def get_population_years(self, iso, url, executor=None, window=2):
+        # admin levels are probed in order up to the first missing one. With an executor, window levels are probed
+        # at once so that at most window - 1 levels beyond the first missing one are requested
+        urls = self.get_population_urls(iso, url)
+
+        def probe(adm):
+            return self.get_population_year(urls[adm], adm)
+
+        if executor is None:
+            results = (probe(adm) for adm in range(len(urls)))
+        else:
+            results = self.map_ahead(executor, probe, range(len(urls)), window)
+        years = dict()
+        with closing(results):
+            for adm, (exists, year) in enumerate(results):
+                if not self.add_population_year(years, urls, adm, exists, year):
+                    break
+        return years
 
     def add_population_services(self, dataset, iso, url):
-        country_name = Country.get_country_name_from_iso3(iso)
+        return self.add_population_dataset(*self._add_population_services(dataset, iso, url))
 
-        resources = list()
-        do_not_continue = False
-        for adm in range(0, 5):
-            resource = dict()
-            if do_not_continue:
-                continue
+    def generate_population_datasets(self, countries, url):
+        # countries are processed concurrently and each country probes its admin levels in a shared pool of
+        # self.probes threads which caps the number of concurrent population requests
+        executor = None
+        if self.probes > 1:
+            executor = ThreadPoolExecutor(max_workers=self.probes)
+        generate = partial(self._generate_population_dataset, url=url, executor=executor)
+        try:
+            for result in self.map(generate, countries):
+                yield self.add_population_dataset(*result)
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
-            resource["url"] = url.replace("/iso", f"/{iso}").replace("/adm/", f"/{adm}/")
-            resource["name"] = f"{iso.upper()} admin {adm} population"
-            resource["format"] = "JSON"
-            try:
-                year = self.retriever.download_json(resource["url"], file_prefix=str(adm))
-            except (DownloadError, FileNotFoundError):
-                do_not_continue = True
-                continue
+    def add_population_dataset(self, dataset, errors):
+        for error in errors:
+            self.errors.add(error)
+        if not dataset:
+            return None, None
+        return dataset, self.get_batch(dataset["owner_org"])
 
-            if len(year) == 1 and year[0].get("status"):
-                do_not_continue = True
-                continue
+    def _generate_population_dataset(self, iso, url, executor):
+        name = f"cod-ps-{iso.lower()}"
+        try:
+            dataset = self.hdx_datasets.read(name)
+        except (CircuitOpenError, HDXError) as ex:
+            return None, [self.get_read_error(name, ex)]
+        if not dataset:
+            return None, list()
+        return self._add_population_services(dataset, iso, url, executor)
 
-            year = year.get("Year")
-            if not year:
-                continue
+    def _add_population_services(self, dataset, iso, url, executor=None):
+        try:
+            years = self.get_population_years(iso, url, executor)
+        except (CircuitOpenError, DownloadError) as ex:  # while the circuit is open the remaining countries fail at once
+            return None, [self.get_probe_error(dataset, ex)]
+        return self.set_population_resources(dataset, iso, years)
 
-            resource["description"] = f"{country_name} administrative level {adm} {year} population statistics"
-            resources.append(resource)
+    @staticmethod
+    def get_read_error(name, ex):
+        return f"Dataset: {name} could not be read from HDX. Error: {ex}"
+
+    @staticmethod
+    def get_probe_error(dataset, ex):
+        # the dataset is not published rather than losing the population services of the admin levels not probed
+        return f"Dataset: {dataset['name']} population services could not be probed. Error: {ex}"
+
+    def set_population_resources(self, dataset, iso, years):
+        errors = list()
+        country_name = Country.get_country_name_from_iso3(iso)
+
+        resources = list()
+        for adm, (resource_url, year) in years.items():
+            resources.append(
+                {
+                    "url": resource_url,
+                    "name": f"{iso.upper()} admin {adm} population",
+                    "format": "JSON",
+                    "description": f"{country_name} administrative level {adm} {year} population statistics",
+                }
+            )
 
         for resource in reversed(dataset.get_resources()):
             if resource.get_file_type() not in ["geoservice", "json"]:
                 continue
             if "itos.uga.edu" not in resource["url"]:
-                self.errors.add(f"Dataset: {dataset['name']} has service resource {resource['url']}")
+                errors.append(f"Dataset: {dataset['name']} has service resource {resource['url']}")
                 continue
 
             try:
                 dataset.delete_resource(resource, delete=False)
             except HDXError:
-                self.errors.add(f"Dataset: {dataset['name']} service resources could not be deleted")
+                errors.append(f"Dataset: {dataset['name']} service resources could not be deleted")
                 continue
 
         try:
             dataset.add_update_resources(resources)
         except HDXError as ex:
-            self.errors.add(f"Dataset: {dataset['name']} resources could not be added. Error: {ex}")
-            return None, None
+            errors.append(f"Dataset: {dataset['name']} resources could not be added. Error: {ex}")
+            return None, errors
 
-        organization_id = dataset.get_organization()["id"]
-        batch = self.batches_by_org.get(organization_id, get_uuid())
-        self.batches_by_org[organization_id] = batch
-
-        return dataset, batch
+        return dataset, errors
@@ -0,0 +1,30 @@
+from functools import lru_cache
+
+from hdx.data.date_helper import DateHelper
+
+
+@lru_cache(maxsize=None)
+def parse_daterange(daterange):
+    # the same few daterange strings recur across the resources and versions of the catalogue so each one is only
+    # parsed once per process. The open end of an ongoing range is fixed when DateHelper is imported so caching
+    # does not change it
+    date_info = DateHelper.get_reference_period_info(daterange)
+    return date_info["startdate"], date_info["enddate"], date_info["ongoing"]
+
+
+def get_reference_period(dateranges):
+    # earliest start and latest end of the ranges, ongoing if the first range with the latest end is ongoing
+    startdate = None
+    enddate = None
+    ongoing = False
+    for daterange in dateranges:
+        resource_startdate, resource_enddate, resource_ongoing = parse_daterange(daterange)
+        if startdate is None or resource_startdate < startdate:
+            startdate = resource_startdate
+        if enddate is None or resource_enddate > enddate:
+            enddate = resource_enddate
+            ongoing = resource_ongoing
+    if ongoing:
+        enddate = "*"
+    return startdate, enddate, ongoing
+
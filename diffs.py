@@ -0,0 +1,109 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from fingerprints import dataset_fields, resource_fields
+
+logger = logging.getLogger(__name__)
+
+
+def get_field(data, field):
+    # lists of tags and groups are compared by name as HDX adds other keys to them
+    value = data.get(field)
+    if field in ("tags", "groups") and value:
+        return sorted(x["name"] for x in value)
+    return value
+
+
+def get_resource_field(data, field):
+    # HDX can return formats in upper case while generated resources have them in lower case
+    value = data.get(field)
+    if field == "format" and value:
+        return value.lower()
+    return value
+
+
+def diff_resources(resources, existing_resources):
+    existing_resources = {x["name"]: x for x in existing_resources}
+    names = [x["name"] for x in resources]
+    result = dict()
+    added = [name for name in names if name not in existing_resources]
+    if added:
+        result["added"] = added
+    removed = [name for name in existing_resources if name not in names]
+    if removed:
+        result["removed"] = removed
+    changed = dict()
+    for resource in resources:
+        existing_resource = existing_resources.get(resource["name"])
+        if existing_resource is None:
+            continue
+        fields = dict()
+        for field in resource_fields:
+            old = get_resource_field(existing_resource, field)
+            new = get_resource_field(resource, field)
+            if old != new:
+                fields[field] = {"old": old, "new": new}
+        if fields:
+            changed[resource["name"]] = fields
+    if changed:
+        result["changed"] = changed
+    existing_names = [name for name in existing_resources if name in names]
+    if not result and existing_names != names:
+        result["reordered"] = names
+    return result
+
+
+def diff_dataset(dataset, existing):
+    # only fields set by the scraper are compared, returning None if the dataset would not change
+    name = dataset["name"]
+    resources = [resource.data for resource in dataset.get_resources()]
+    if existing is None:
+        return {"name": name, "status": "new", "resources": {"added": [x["name"] for x in resources]}}
+    fields = dict()
+    for field in dataset_fields:
+        if field == "name" or field not in dataset.data:
+            continue
+        old = get_field(existing.data, field)
+        new = get_field(dataset.data, field)
+        if old != new:
+            fields[field] = {"old": old, "new": new}
+    resources = diff_resources(resources, [resource.data for resource in existing.get_resources()])
+    if not fields and not resources:
+        return None
+    result = {"name": name, "status": "changed"}
+    if fields:
+        result["fields"] = fields
+    if resources:
+        result["resources"] = resources
+    return result
+
+
+class DatasetDiffer:
+    def __init__(self, hdx_datasets, workers=1):
+        self.hdx_datasets = hdx_datasets
+        self.workers = workers
+        self.unchanged = 0
+
+    def diff_one(self, dataset):
+        return diff_dataset(dataset, self.hdx_datasets.read(dataset["name"]))
+
+    def diff(self, datasets):
+        # datasets are compared concurrently, which matters when HDX datasets could not be prefetched and are read
+        # one by one, and the diffs are returned in input order
+        if self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(self.diff_one, datasets))
+        else:
+            results = [self.diff_one(dataset) for dataset in datasets]
+        diffs = [x for x in results if x is not None]
+        self.unchanged += len(results) - len(diffs)
+        for diff in diffs:
+            logger.info(f"Dataset: {diff['name']} is {diff['status']}: {', '.join(self.get_summary(diff))}")
+        return diffs
+
+    @staticmethod
+    def get_summary(diff):
+        summary = list(diff.get("fields", dict()))
+        for change, names in diff.get("resources", dict()).items():
+            summary.append(f"{len(names)} resources {change}")
+        return summary
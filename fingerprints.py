@@ -0,0 +1,72 @@
+import logging
+from hashlib import sha256
+from json import dumps
+from os.path import exists
+
+from hdx.utilities.loader import load_json
+from hdx.utilities.saver import save_json
+
+logger = logging.getLogger(__name__)
+
+# only fields set by the scraper are fingerprinted so that fields maintained by HDX do not count as changes
+dataset_fields = (
+    "name",
+    "title",
+    "notes",
+    "dataset_source",
+    "methodology",
+    "methodology_other",
+    "license_id",
+    "license_other",
+    "caveats",
+    "data_update_frequency",
+    "cod_level",
+    "customviz",
+    "maintainer",
+    "owner_org",
+    "subnational",
+    "groups",
+    "tags",
+    "dataset_date",
+    "is_requestdata_type",
+    "file_types",
+    "field_names",
+    "num_of_rows",
+)
+resource_fields = ("name", "description", "url", "format", "daterange_for_data")
+
+
+def get_fingerprint(dataset):
+    data = {
+        "dataset": {x: dataset[x] for x in dataset_fields if x in dataset.data},
+        "resources": [{x: resource.get(x) for x in resource_fields} for resource in dataset.get_resources()],
+    }
+    return sha256(dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class Fingerprints:
+    def __init__(self, path=None, force=False):
+        self.path = path
+        self.force = force
+        self.fingerprints = dict()
+        if path and exists(path):
+            self.fingerprints = load_json(path)
+        self.pushed = 0
+        self.skipped = 0
+
+    def is_unchanged(self, name, fingerprint):
+        if self.force or not self.path:
+            return False
+        if self.fingerprints.get(name) != fingerprint:
+            return False
+        self.skipped += 1
+        return True
+
+    def update(self, name, fingerprint):
+        self.fingerprints[name] = fingerprint
+        self.pushed += 1
+
+    def save(self):
+        if not self.path:
+            return
+        save_json(self.fingerprints, self.path)
@@ -0,0 +1,51 @@
+import logging
+from copy import deepcopy
+
+from hdx.data.dataset import Dataset
+from hdx.data.hdxobject import HDXError
+from hdx.data.resource import Resource
+
+from instrumentation import run_report
+from resilience import CircuitOpenError, Upstream
+
+logger = logging.getLogger(__name__)
+
+
+class DatasetIndex:
+    def __init__(self, prefixes=("cod-ab-", "cod-em-", "cod-ps-"), upstream=None):
+        self.prefixes = prefixes
+        if upstream is None:
+            upstream = Upstream("hdx_read")
+        self.upstream = upstream
+        self.datasets = None
+
+    def prefetch(self):
+        # private datasets are included as the index is then the only source for names with these prefixes
+        query = " OR ".join(f"name:{prefix}*" for prefix in self.prefixes)
+        try:
+            with run_report.stage("search_in_hdx"):
+                datasets = self.upstream.call(Dataset.search_in_hdx, fq=query, include_private=True)
+        except (CircuitOpenError, HDXError):
+            logger.exception("Could not prefetch datasets from HDX, reading them one by one instead")
+            return
+        self.datasets = {dataset["name"]: dataset for dataset in datasets}
+        logger.info(f"Prefetched {len(self.datasets)} datasets from HDX")
+
+    def read(self, name):
+        # once prefetched, the index is authoritative for names with the prefetched prefixes
+        if self.datasets is not None and name.startswith(self.prefixes):
+            dataset = self.datasets.get(name)
+            if dataset is None:
+                return None
+            return self.copy(dataset)
+        with run_report.stage("read_from_hdx"):
+            return self.upstream.call(Dataset.read_from_hdx, name)
+
+    @staticmethod
+    def copy(dataset):
+        # callers change the datasets they read, eg. the population services, so each read gets its own copy and
+        # the index keeps what is on HDX for the dry run to diff against
+        configuration = dataset.configuration
+        copied = Dataset(deepcopy(dataset.data), configuration=configuration)
+        copied.resources = [Resource(deepcopy(x.data), configuration=configuration) for x in dataset.get_resources()]
+        return copied
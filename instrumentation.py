@@ -0,0 +1,229 @@
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from os.path import getsize, join
+from shutil import copyfile
+from threading import Lock
+from time import perf_counter
+
+from hdx.utilities.loader import load_json
+from hdx.utilities.retriever import Retrieve
+from hdx.utilities.saver import save_json
+
+logger = logging.getLogger(__name__)
+
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# timings of a whole process, which shards run in parallel
+process_values = ("duration_seconds", "startup_imports_seconds", "startup_seconds")
+
+
+class RunReport:
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = dict()
+            self.values = dict()
+            self.sections = dict()
+            self.histograms = dict()
+
+    def add_time(self, stage, seconds, calls=1):
+        with self.lock:
+            totals = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0})
+            totals["calls"] += calls
+            totals["seconds"] += seconds
+
+    @contextmanager
+    def stage(self, stage):
+        # stages running in several threads at once add up their time so seconds can exceed wall time
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, perf_counter() - start)
+
+    def timed(self, stage):
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def observe(self, name, seconds, outcome):
+        # latency histogram and outcome counts of calls to an endpoint. Bucket counts are not cumulative, the last
+        # bucket being for calls slower than the largest bound
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                name, {"calls": 0, "seconds": 0.0, "buckets": [0] * (len(latency_buckets) + 1), "outcomes": dict()}
+            )
+            histogram["calls"] += 1
+            histogram["seconds"] += seconds
+            histogram["buckets"][bisect_left(latency_buckets, seconds)] += 1
+            histogram["outcomes"][outcome] = histogram["outcomes"].get(outcome, 0) + 1
+
+    def add_section(self, name, rows):
+        with self.lock:
+            self.sections[name] = rows
+
+    def merge(self, report):
+        # used to combine the reports of shards: times, calls and values add up except the process timings
+        # which are those of the slowest shard, and list sections are concatenated
+        for stage, totals in report["stages"].items():
+            self.add_time(stage, totals["seconds"], totals["calls"])
+        with self.lock:
+            for name, value in report["values"].items():
+                if name in process_values:
+                    self.values[name] = max(self.values.get(name, 0), value)
+                else:
+                    self.values[name] = self.values.get(name, 0) + value
+            for name, histogram in report.get("histograms", dict()).items():
+                totals = self.histograms.setdefault(
+                    name, {"calls": 0, "seconds": 0.0, "buckets": [0] * (len(latency_buckets) + 1), "outcomes": dict()}
+                )
+                totals["calls"] += histogram["calls"]
+                totals["seconds"] += histogram["seconds"]
+                for i, count in enumerate(histogram["buckets"].values()):
+                    totals["buckets"][i] += count
+                for outcome, count in histogram["outcomes"].items():
+                    totals["outcomes"][outcome] = totals["outcomes"].get(outcome, 0) + count
+            for name, rows in report.items():
+                if name in ("stages", "values") or not isinstance(rows, list):
+                    continue
+                self.sections.setdefault(name, list()).extend(rows)
+
+    def get_report(self):
+        with self.lock:
+            stages = {stage: {"calls": x["calls"], "seconds": round(x["seconds"], 3)} for stage, x in self.stages.items()}
+            bounds = [str(x) for x in latency_buckets] + ["+Inf"]
+            histograms = {
+                name: {
+                    "calls": x["calls"],
+                    "seconds": round(x["seconds"], 3),
+                    "buckets": dict(zip(bounds, x["buckets"])),
+                    "outcomes": dict(x["outcomes"]),
+                }
+                for name, x in self.histograms.items()
+            }
+            return {"stages": stages, "values": dict(self.values), "histograms": histograms, **self.sections}
+
+    def get_prometheus(self, prefix="cods"):
+        report = self.get_report()
+        lines = [f"# TYPE {prefix}_stage_seconds gauge", f"# TYPE {prefix}_stage_calls gauge"]
+        for stage, totals in report["stages"].items():
+            lines.append(f'{prefix}_stage_seconds{{stage="{stage}"}} {totals["seconds"]}')
+            lines.append(f'{prefix}_stage_calls{{stage="{stage}"}} {totals["calls"]}')
+        for name, value in report["values"].items():
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {value}")
+        if report["histograms"]:
+            lines.append(f"# TYPE {prefix}_endpoint_seconds histogram")
+        for name, histogram in report["histograms"].items():
+            count = 0
+            for bound, bucket in histogram["buckets"].items():
+                count += bucket
+                lines.append(f'{prefix}_endpoint_seconds_bucket{{endpoint="{name}",le="{bound}"}} {count}')
+            lines.append(f'{prefix}_endpoint_seconds_sum{{endpoint="{name}"}} {histogram["seconds"]}')
+            lines.append(f'{prefix}_endpoint_seconds_count{{endpoint="{name}"}} {histogram["calls"]}')
+        if report["histograms"]:
+            lines.append(f"# TYPE {prefix}_endpoint_outcomes gauge")
+        for name, histogram in report["histograms"].items():
+            for outcome, value in histogram["outcomes"].items():
+                lines.append(f'{prefix}_endpoint_outcomes{{endpoint="{name}",outcome="{outcome}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def log(self):
+        for stage, totals in self.get_report()["stages"].items():
+            logger.info(f"Stage {stage}: {totals['calls']} calls in {totals['seconds']}s")
+        for name, value in self.values.items():
+            logger.info(f"{name}: {value}")
+        for name, histogram in self.get_report()["histograms"].items():
+            outcomes = ", ".join(f"{outcome}: {count}" for outcome, count in histogram["outcomes"].items())
+            logger.info(f"Endpoint {name}: {histogram['calls']} calls in {histogram['seconds']}s ({outcomes})")
+
+    def save(self, folder, filename="run_report"):
+        save_json(self.get_report(), join(folder, f"{filename}.json"))
+        with open(join(folder, f"{filename}.prom"), "w") as f:
+            f.write(self.get_prometheus())
+
+    @contextmanager
+    def write_on_exit(self, folder, errors, filename="run_report"):
+        start = perf_counter()
+        try:
+            yield self
+        finally:
+            self.set("duration_seconds", round(perf_counter() - start, 3))
+            self.set("errors", len(errors.errors))
+            self.add_section("errors", list(errors.errors))
+            self.log()
+            if folder:
+                self.save(folder, filename)
+
+
+run_report = RunReport()
+
+
+class InstrumentedRetrieve(Retrieve):
+    def __init__(self, *args, http_cache=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.http_cache = http_cache
+
+    def clone(self, downloader):
+        return InstrumentedRetrieve(
+            downloader,
+            fallback_dir=self.fallback_dir,
+            saved_dir=self.saved_dir,
+            temp_dir=self.temp_dir,
+            save=self.save,
+            use_saved=self.use_saved,
+            prefix=self.prefix,
+            delete=False,
+            http_cache=self.http_cache,
+        )
+
+    def download_cached(self, url, filename, logstr, **kwargs):
+        # the body is copied out of the cache to where Retrieve would have downloaded it, so that the cache can
+        # evict it while the copy is being read
+        logger.log(self.log_level, f"Fetching {logstr} from {self.get_url_logstr(url)} through the HTTP cache")
+        blob_path, size = self.http_cache.fetch(self.downloader, url, kwargs.get("parameters"), kwargs.get("timeout"))
+        run_report.add("bytes_downloaded", size)
+        path = join(self.saved_dir if self.save else self.temp_dir, filename)
+        try:
+            copyfile(blob_path, path)
+        finally:
+            self.http_cache.release(blob_path)
+        return path
+
+    def download_file(self, url, filename=None, logstr=None, *args, **kwargs):
+        with run_report.stage("download"):
+            if self.http_cache and not self.use_saved:
+                filename, kwargs = self.get_filename(url, filename, **kwargs)
+                return self.download_cached(url, filename, logstr or filename, **kwargs)
+            path = super().download_file(url, filename, logstr, *args, **kwargs)
+        if not self.use_saved:
+            run_report.add("bytes_downloaded", getsize(path))
+        return path
+
+    def download_json(self, url, filename=None, logstr=None, *args, **kwargs):
+        with run_report.stage("download"):
+            if self.http_cache and not self.use_saved:
+                filename, kwargs = self.get_filename(url, filename, ("json",), **kwargs)
+                return load_json(self.download_cached(url, filename, logstr or filename, **kwargs))
+            rjson = super().download_json(url, filename, logstr, *args, **kwargs)
+        if not self.use_saved and self.downloader.response is not None:
+            run_report.add("bytes_downloaded", len(self.downloader.response.content))
+        return rjson
@@ -0,0 +1,78 @@
+import logging
+from json import dumps, loads
+from os import fsync
+from os.path import exists
+from threading import Lock
+from time import time
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    def __init__(self, path=None, resume=False):
+        # each stage reached by a dataset is appended as a json line and flushed to disk before moving on
+        # so that a killed run can be resumed from where it stopped
+        self.path = path
+        self.entries = dict()
+        self.lock = Lock()
+        self.file = None
+        if not path:
+            return
+        if resume and exists(path):
+            terminated = self.load()
+            self.file = open(path, "a")
+            if not terminated:
+                self.file.write("\n")
+        else:
+            self.file = open(path, "w")
+
+    def load(self):
+        # returns whether the last line is complete so that an incomplete one can be terminated before appending
+        terminated = True
+        with open(self.path) as f:
+            for line in f:
+                terminated = line.endswith("\n")
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = loads(line)
+                except ValueError:  # the last line can be incomplete if the run was killed while writing it
+                    logger.warning(f"Ignoring incomplete journal line: {line}")
+                    continue
+                self.entries.setdefault(entry["name"], dict()).update(entry)
+        uploaded = sum(1 for entry in self.entries.values() if entry["stage"] == "uploaded")
+        logger.info(f"Resuming from {self.path}: {len(self.entries)} datasets journaled, {uploaded} uploaded")
+        return terminated
+
+    def record(self, name, stage, batch=None, organization=None):
+        if self.file is None:
+            return
+        entry = {"name": name, "stage": stage, "time": time()}
+        if batch:
+            entry["batch"] = batch
+        if organization:
+            entry["organization"] = organization
+        with self.lock:
+            self.entries.setdefault(name, dict()).update(entry)
+            self.file.write(f"{dumps(entry)}\n")
+            self.file.flush()
+            fsync(self.file.fileno())
+
+    def get_stage(self, name):
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        return entry["stage"]
+
+    def is_uploaded(self, name):
+        return self.get_stage(name) == "uploaded"
+
+    def get_batches(self):
+        # the batch used for each organization so that resumed uploads stay in the same batch
+        return {x["organization"]: x["batch"] for x in self.entries.values() if x.get("organization") and x.get("batch")}
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,40 @@
+import logging
+from threading import Lock
+
+from hdx.data.organization import Organization
+
+from caches import PersistentCache
+from instrumentation import run_report
+from resilience import Upstream
+
+logger = logging.getLogger(__name__)
+
+
+class OrganizationResolver(PersistentCache):
+    def __init__(self, path=None, ttl=None, upstream=None):
+        super().__init__(path, ttl)
+        if upstream is None:
+            upstream = Upstream("hdx_read")
+        self.upstream = upstream
+        self.locks = dict()
+
+    def get_lock(self, contributor):
+        with self.lock:
+            return self.locks.setdefault(contributor, Lock())
+
+    def resolve(self, contributor):
+        # invalid contributors are cached as None so that they are only looked up once. Lookups that fail are not
+        # cached and raise HDXError or CircuitOpenError
+        with self.get_lock(contributor):
+            found, organization_id = self.get(contributor)
+            if found:
+                return organization_id
+            with run_report.stage("autocomplete"):
+                organization = self.upstream.call(Organization.autocomplete, contributor)
+            if len(organization) == 0:
+                with run_report.stage("autocomplete"):
+                    organization = self.upstream.call(Organization.autocomplete, contributor.replace(" ", "-"))
+            if len(organization) > 0:
+                organization_id = organization[0]["id"]
+            self.set(contributor, organization_id)
+            return organization_id
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+from ast import literal_eval
+from random import uniform
+from threading import Lock
+from time import monotonic, perf_counter, sleep
+
+from ckanapi.errors import CKANAPIError
+from requests.exceptions import ConnectionError, Timeout
+
+from instrumentation import run_report
+
+logger = logging.getLogger(__name__)
+
+transient_statuses = (429, 500, 502, 503, 504)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def get_causes(ex):
+    while ex is not None:
+        yield ex
+        ex = ex.__cause__ or ex.__context__
+
+
+def get_ckan_status(ex):
+    # ckanapi raises an error it does not recognise, such as a 503 from a proxy, as CKANAPIError(repr([url, status, body]))
+    try:
+        status = literal_eval(ex.extra_msg)[1]
+    except (IndexError, SyntaxError, TypeError, ValueError):
+        return None
+    return status if isinstance(status, int) else None
+
+
+def get_status(ex):
+    # the HTTP status of a requests, aiohttp or ckanapi error anywhere in the chain
+    for cause in get_causes(ex):
+        response = getattr(cause, "response", None)
+        status = getattr(response, "status_code", None) or getattr(cause, "status", None)
+        if status is None and type(cause) is CKANAPIError:
+            status = get_ckan_status(cause)
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def is_not_found(ex):
+    # FileNotFoundError is what a retriever using saved data raises for a download that was never saved
+    return get_status(ex) == 404 or any(isinstance(cause, FileNotFoundError) for cause in get_causes(ex))
+
+
+def is_transient(ex, transient_errors=(ConnectionError, Timeout)):
+    # HDXError and DownloadError wrap the underlying ckanapi, requests or aiohttp exception so look down the chain
+    status = get_status(ex)
+    if status is not None:
+        return status in transient_statuses
+    return any(isinstance(cause, transient_errors) for cause in get_causes(ex))
+
+
+class Upstream:
+    def __init__(self, name, retries=0, backoff=1, threshold=None, cooldown=60):
+        # transient failures are retried with full jitter backoff. After threshold consecutive transient failures
+        # the circuit opens, retries stop and calls fail at once for cooldown seconds, after which one trial call is let
+        # through
+        self.name = name
+        self.retries = retries
+        self.backoff = backoff
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened is None:
+                return
+            if self.trial or monotonic() - self.opened < self.cooldown:
+                run_report.observe(self.name, 0, "rejected")
+                raise CircuitOpenError(f"Circuit for {self.name} is open after {self.failures} consecutive failures")
+            self.trial = True
+
+    def after_call(self, seconds, ex=None, transient_errors=(ConnectionError, Timeout)):
+        # returns the outcome of the call
+        if ex is None:
+            outcome = "ok"
+        elif is_not_found(ex):
+            outcome = "not_found"
+        elif is_transient(ex, transient_errors):
+            outcome = "transient"
+        else:
+            outcome = "failed"
+        run_report.observe(self.name, seconds, outcome)
+        with self.lock:
+            self.trial = False
+            if outcome == "transient":
+                self.failures += 1
+                if self.threshold and self.failures >= self.threshold:
+                    if self.opened is None:
+                        logger.error(f"Opening circuit for {self.name} after {self.failures} consecutive failures")
+                    self.opened = monotonic()
+            else:
+                self.failures = 0
+                self.opened = None
+        return outcome
+
+    def get_wait(self, attempt):
+        return uniform(0, self.backoff * 2 ** (attempt - 1))
+
+    def call(self, function, *args, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            self.before_call()
+            start = perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as ex:
+                outcome = self.after_call(perf_counter() - start, ex)
+                if outcome != "transient" or attempt > self.retries or self.opened is not None:
+                    raise
+                wait = self.get_wait(attempt)
+                logger.warning(f"{self.name} attempt {attempt} failed with {ex}, retrying in {wait:.2f}s")
+                sleep(wait)
+                continue
+            self.after_call(perf_counter() - start)
+            return result
+
+    async def call_async(self, function, *args, transient_errors=(ConnectionError, Timeout), **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            self.before_call()
+            start = perf_counter()
+            try:
+                result = await function(*args, **kwargs)
+            except Exception as ex:
+                outcome = self.after_call(perf_counter() - start, ex, transient_errors)
+                if outcome != "transient" or attempt > self.retries or self.opened is not None:
+                    raise
+                wait = self.get_wait(attempt)
+                logger.warning(f"{self.name} attempt {attempt} failed with {ex}, retrying in {wait:.2f}s")
+                await asyncio.sleep(wait)
+                continue
+            self.after_call(perf_counter() - start)
+            return result
@@ -1,18 +1,8 @@
 import argparse
 import logging
+from contextlib import ExitStack, closing
 from os.path import expanduser, join
-
-from cods import COD
-
-from hdx.api.configuration import Configuration
-from hdx.data.dataset import Dataset
-from hdx.data.hdxobject import HDXError
-from hdx.facades.keyword_arguments import facade
-from hdx.location.country import Country
-from hdx.utilities.downloader import Download
-from hdx.utilities.errors_onexit import ErrorsOnExit
-from hdx.utilities.path import temp_dir
-from hdx.utilities.retriever import Retrieve
+from time import perf_counter
 
 logger = logging.getLogger(__name__)
 
@@ -30,7 +20,76 @@ def parse_args():
     parser.add_argument(
         "-usv", "--use_saved", default=False, action="store_true", help="Use saved data",
     )
+    parser.add_argument(
+        "-w", "--workers", default=1, type=int, help="Number of datasets to generate concurrently"
+    )
+    parser.add_argument(
+        "-p", "--probes", default=1, type=int, help="Number of population admin levels to probe concurrently"
+    )
+    parser.add_argument(
+        "-ac", "--async_concurrency", default=0, type=int, help="Use the asyncio engine with this many concurrent requests"
+    )
+    parser.add_argument(
+        "-av", "--all_versions", default=False, action="store_true", help="Publish historical versions of resources"
+    )
+    parser.add_argument(
+        "-uw", "--upload_workers", default=1, type=int, help="Number of batches to upload concurrently"
+    )
+    parser.add_argument(
+        "-oc", "--organizations_cache", default=None, help="File in which to cache organization lookups"
+    )
+    parser.add_argument(
+        "-pc", "--population_cache", default=None, help="File in which to cache population years"
+    )
+    parser.add_argument(
+        "-hc", "--http_cache", default=None, help="Folder in which to cache downloads between runs"
+    )
+    parser.add_argument(
+        "-cc", "--catalogue_cache", default=None, help="File in which to keep the indexed catalogue between runs"
+    )
+    parser.add_argument(
+        "-rd", "--reference_data", default=None, help="Folder in which to cache countries and vocabulary between runs"
+    )
+    parser.add_argument(
+        "-sf", "--state_file", default=None, help="File in which to keep fingerprints of uploaded datasets"
+    )
+    parser.add_argument(
+        "-rf", "--report_folder", default=None, help="Folder in which to write the run report"
+    )
+    parser.add_argument(
+        "-sh", "--shard", default=0, type=int, help="Index of the shard of countries to run starting from 0"
+    )
+    parser.add_argument(
+        "-ns", "--shards", default=1, type=int, help="Number of shards the countries are split into"
+    )
+    parser.add_argument(
+        "-ri", "--run_id", default=None, help="Identifier shared by all shards of a run"
+    )
+    parser.add_argument(
+        "-ms", "--merge_shards", default=False, action="store_true", help="Merge the shard reports in the report folder"
+    )
+    parser.add_argument(
+        "-j", "--journal", default=None, help="File in which to journal the progress of each dataset"
+    )
+    parser.add_argument(
+        "-r", "--resume", default=False, action="store_true", help="Skip datasets uploaded according to the journal"
+    )
+    parser.add_argument(
+        "-dr", "--dry_run", default=False, action="store_true", help="Diff datasets against HDX instead of uploading"
+    )
+    parser.add_argument(
+        "-f", "--force", default=False, action="store_true", help="Upload datasets even if unchanged"
+    )
     args = parser.parse_args()
+    if args.shards > 1 and not args.merge_shards:
+        if not args.run_id:
+            parser.error("--run_id is required when running shards")
+        if not 0 <= args.shard < args.shards:
+            parser.error("--shard must be between 0 and --shards - 1")
+    if args.resume and not args.journal:
+        parser.error("--journal is required to resume")
+    if args.merge_shards and not args.report_folder:
+        parser.error("--report_folder is required to merge shards")
     return args
 
 
@@ -38,68 +97,289 @@ def main(
     countries_override,
     save,
     use_saved,
+    workers=1,
+    probes=1,
+    async_concurrency=0,
+    all_versions=False,
+    upload_workers=1,
+    organizations_cache=None,
+    population_cache=None,
+    http_cache=None,
+    catalogue_cache=None,
+    reference_data=None,
+    state_file=None,
+    force=False,
+    report_folder=None,
+    shard=0,
+    shards=1,
+    run_id=None,
+    journal=None,
+    resume=False,
+    dry_run=False,
+    imports_seconds=None,
+    started=None,
     **ignore,
 ):
+    # modules are imported here and in the branches that use them so that merging shards does not import them and a
+    # dry run does not import the uploader
+    imports_started = perf_counter()
+    from caches import HTTPCache, PersistentCache
+    from cods import COD
+    from hdx_datasets import DatasetIndex
+    from instrumentation import InstrumentedRetrieve, run_report
+    from journal import Journal
+    from organizations import OrganizationResolver
+    from resilience import Upstream
+    from sharding import get_metadata_iso3, get_shard_filename, in_shard
+    from startup import ReferenceData
+
+    from hdx.api.configuration import Configuration
+    from hdx.location.country import Country
+    from hdx.utilities.downloader import Download
+    from hdx.utilities.errors_onexit import ErrorsOnExit
+    from hdx.utilities.path import temp_dir
+
     configuration = Configuration.read()
-    with ErrorsOnExit() as errors:
-        with temp_dir() as temp_folder:
+    if started is not None:
+        run_report.add_time("configuration", imports_started - started - imports_seconds)
+        imports_seconds += perf_counter() - imports_started
+    report_filename = "run_report"
+    if shards > 1:
+        report_filename = get_shard_filename(shard, shards)
+        run_report.add_section("shard", {"shard": shard, "shards": shards, "run_id": run_id})
+    if dry_run:  # a dry run must not truncate the journal of the run it previews
+        journal = None
+    journal = Journal(journal, resume)
+    with ErrorsOnExit() as errors, run_report.write_on_exit(report_folder, errors, report_filename):
+        with temp_dir() as temp_folder, closing(journal), ExitStack() as cleanup:
+            reference_data = ReferenceData(reference_data, configuration["reference_data_ttl"])
+            reference_data.load()
+            if started is not None:
+                startup_seconds = perf_counter() - started
+                logger.info(f"Started in {startup_seconds:.3f}s of which imports took {imports_seconds:.3f}s")
+                run_report.set("startup_imports_seconds", round(imports_seconds, 3))
+                run_report.set("startup_seconds", round(startup_seconds, 3))
             with Download() as downloader:
-                retriever = Retrieve(
-                    downloader, temp_folder, "saved_data", temp_folder, save, use_saved
+                if http_cache:
+                    http_cache = HTTPCache(
+                        http_cache, configuration["http_cache_ttl"], configuration["http_cache_max_bytes"]
+                    )
+                retriever = InstrumentedRetrieve(
+                    downloader, temp_folder, "saved_data", temp_folder, save, use_saved, http_cache=http_cache
                 )
-                cod = COD(retriever, errors)
-                datasets_metadata = cod.get_datasets_metadata(
-                    configuration["url"],
-                    countries_override,
-                    enhanced_only=True,
-                    boundaries_only=True,
+                resilience = {
+                    "retries": configuration["upstream_retries"],
+                    "backoff": configuration["upstream_backoff"],
+                    "threshold": configuration["upstream_failure_threshold"],
+                    "cooldown": configuration["upstream_cooldown"],
+                }
+                hdx_read = Upstream("hdx_read", **resilience)  # shared by the dataset reads and organization lookups
+                organizations = OrganizationResolver(
+                    organizations_cache, configuration["organizations_cache_ttl"], hdx_read
                 )
-                logger.info(f"Number of datasets to upload: {len(datasets_metadata)}")
-                datasets_to_update = []
-                for metadata in datasets_metadata:
-                    dataset, batch = cod.generate_dataset(metadata, latest_only=True)
+                hdx_datasets = DatasetIndex(upstream=hdx_read)
+                if not countries_override or dry_run:
+                    hdx_datasets.prefetch()
+                population_years = PersistentCache(population_cache, configuration["population_cache_ttl"])
+                cod = COD(
+                    retriever,
+                    errors,
+                    workers=workers,
+                    organizations=organizations,
+                    hdx_datasets=hdx_datasets,
+                    probes=probes,
+                    population_years=population_years,
+                    run_id=run_id,
+                    catalogue_cache=catalogue_cache,
+                    max_resources=configuration["max_resources_per_dataset"],
+                    resilience=resilience,
+                )
+                cod.batches_by_org.update(journal.get_batches())
+
+                def save_caches():
+                    # runs however generation ends so that the lookups made before a failure are kept
+                    run_report.set("organization_cache_hits", organizations.hits)
+                    run_report.set("organization_cache_misses", organizations.misses)
+                    logger.info(
+                        f"Organization lookups: {organizations.hits} cached, {organizations.misses} looked up "
+                        f"for {len(cod.batches_by_org)} organizations"
+                    )
+                    organizations.save()
+                    population_years.save()
+                    run_report.set("population_cache_hits", population_years.hits)
+                    run_report.set("population_cache_misses", population_years.misses)
+                    if http_cache:
+                        http_cache.save()
+                        run_report.set("http_cache_hits", http_cache.hits)
+                        run_report.set("http_cache_revalidated", http_cache.revalidated)
+                        run_report.set("http_cache_misses", http_cache.misses)
+                    reference_data.save()
+
+                cleanup.callback(save_caches)
+                if async_concurrency:  # aiohttp is only imported when the asyncio engine is used
+                    from async_engine import iterate_async, run_async
+
+                    datasets_metadata = run_async(
+                        cod, async_concurrency, "get_datasets_metadata", configuration["url"], countries_override
+                    )
+                else:
+                    datasets_metadata = cod.get_datasets_metadata(
+                        configuration["url"],
+                        countries_override,
+                        enhanced_only=True,
+                        boundaries_only=True,
+                    )
+                selected = 0
+
+                def select(datasets_metadata):
+                    # records are taken from the catalogue one at a time as the datasets are generated
+                    nonlocal selected
+                    for metadata in datasets_metadata:
+                        if not in_shard(get_metadata_iso3(metadata), shard, shards):
+                            continue
+                        if journal.is_uploaded(cod.get_dataset_name(metadata)):
+                            continue
+                        selected += 1
+                        yield metadata
+
+                datasets_metadata = select(datasets_metadata)
+                queue_size = configuration["upload_queue_size"]
+                if dry_run:
+                    from diffs import DatasetDiffer
+
+                    differ = DatasetDiffer(hdx_datasets, workers)
+                    diffs = list()
+                    pending = list()
+                else:
+                    from fingerprints import Fingerprints, get_fingerprint
+                    from uploader import Uploader
+
+                    fingerprints = Fingerprints(state_file, force)
+                    fingerprints_to_upload = dict()
+                    uploader = Uploader(
+                        errors,
+                        upload_workers,
+                        configuration["upload_rate"],
+                        configuration["upload_retries"],
+                        configuration["upload_backoff"],
+                        journal,
+                    )
+                    uploader.start(queue_size)
+
+                    def finish_uploads():
+                        # runs however generation ends so that the queued uploads complete and the fingerprints of
+                        # the uploaded datasets are kept
+                        results = uploader.join()
+                        for result in results:
+                            if result["outcome"] == "uploaded":
+                                fingerprints.update(result["name"], fingerprints_to_upload[result["name"]])
+                        fingerprints.save()
+                        logger.info(
+                            f"Uploaded {fingerprints.pushed} datasets, skipped {fingerprints.skipped} unchanged datasets"
+                        )
+                        run_report.set("datasets_uploaded", fingerprints.pushed)
+                        run_report.set("datasets_skipped", fingerprints.skipped)
+                        run_report.add_section("uploads", uploader.report)
+
+                    cleanup.callback(finish_uploads)
+
+                def hand_off(dataset, batch):
+                    # datasets are diffed or queued for upload as soon as they are generated rather than held until
+                    # generation finishes, blocking generation while the upload queue is full
+                    if dry_run:
+                        pending.append(dataset)
+                        if len(pending) == queue_size:
+                            diffs.extend(differ.diff(pending))
+                            pending.clear()
+                        return
+                    fingerprint = get_fingerprint(dataset)
+                    if fingerprints.is_unchanged(dataset["name"], fingerprint):
+                        return
+                    fingerprints_to_upload[dataset["name"]] = fingerprint
+                    uploader.submit(dataset, batch)
+
+                if async_concurrency:
+                    generated = iterate_async(
+                        cod, async_concurrency, "generate_datasets", datasets_metadata, not all_versions
+                    )
+                else:
+                    generated = cod.generate_datasets(datasets_metadata, latest_only=not all_versions)
+                datasets_generated = 0
+                for dataset, batch in generated:
                     if dataset:
-                        datasets_to_update.append([dataset, batch])
+                        journal.record(dataset["name"], "generated", batch, dataset["owner_org"])
+                        datasets_generated += 1
+                        hand_off(dataset, batch)
+                logger.info(f"Generated {datasets_generated} of {selected} datasets selected from the catalogue")
+                run_report.set("datasets_in_catalogue", selected)
+                run_report.set("datasets_generated", datasets_generated)
 
                 if not countries_override:
                     countries_override = [c for c in Country.countriesdata()["countries"]]
-                for country in countries_override:
-                    dataset = Dataset.read_from_hdx(f"cod-ps-{country.lower()}")
-
-                    if not dataset:
-                        continue
-
-                    dataset, batch = cod.add_population_services(dataset, country, configuration["ps_url"])
+                countries_override = [c for c in countries_override if in_shard(c, shard, shards)]
+                countries_override = [c for c in countries_override if not journal.is_uploaded(f"cod-ps-{c.lower()}")]
+                if async_concurrency:
+                    generated = iterate_async(
+                        cod, async_concurrency, "generate_population_datasets", countries_override, configuration["ps_url"]
+                    )
+                else:
+                    generated = cod.generate_population_datasets(countries_override, configuration["ps_url"])
+                for dataset, batch in generated:
                     if dataset:
-                        datasets_to_update.append([dataset, batch])
-
-                for dataset, batch in datasets_to_update:
-                    try:
-                        dataset.create_in_hdx(
-                            hxl_update=False,
-                            remove_additional_resources=True,
-                            updated_by_script="HDX Scraper: CODS",
-                            batch=batch,
-                            ignore_fields=["num_of_rows", "resource:description"],
-                        )
-                    except HDXError as ex:
-                        logger.exception(f"Dataset: {metadata['DatasetTitle']} could not be uploaded")
-                        errors.add(f"Dataset: {metadata['DatasetTitle']}, error: {ex}")
+                        journal.record(dataset["name"], "population_services", batch, dataset["owner_org"])
+                        hand_off(dataset, batch)
+
+                if dry_run:
+                    diffs.extend(differ.diff(pending))
+                    logger.info(f"Dry run: {len(diffs)} datasets would change, {differ.unchanged} are unchanged")
+                    run_report.set("datasets_changed", len(diffs))
+                    run_report.set("datasets_unchanged", differ.unchanged)
+                    run_report.add_section("diff", diffs)
 
 
 if __name__ == "__main__":
+    started = perf_counter()  # the standard library imports above take a negligible time
     args = parse_args()
-    if args.countries_override:
-        countries_override = args.countries_override.split(",")
+    if args.merge_shards:
+        from sharding import merge_shards
+
+        merge_shards(args.report_folder, args.run_id)
     else:
-        countries_override = None
-    facade(
-        main,
-        hdx_site="prod",
-        user_agent_config_yaml=join(expanduser("~"), ".useragents.yml"),
-        user_agent_lookup=lookup,
-        project_config_yaml=join("config", "project_configuration.yml"),
-        countries_override=countries_override,
-        save=args.save,
-        use_saved=args.use_saved,
-    )
+        from hdx.facades.keyword_arguments import facade
+
+        imports_seconds = perf_counter() - started
+        if args.countries_override:
+            countries_override = args.countries_override.split(",")
+        else:
+            countries_override = None
+        facade(
+            main,
+            hdx_site="prod",
+            user_agent_config_yaml=join(expanduser("~"), ".useragents.yml"),
+            user_agent_lookup=lookup,
+            project_config_yaml=join("config", "project_configuration.yml"),
+            countries_override=countries_override,
+            save=args.save,
+            use_saved=args.use_saved,
+            workers=args.workers,
+            probes=args.probes,
+            async_concurrency=args.async_concurrency,
+            all_versions=args.all_versions,
+            upload_workers=args.upload_workers,
+            organizations_cache=args.organizations_cache,
+            population_cache=args.population_cache,
+            http_cache=args.http_cache,
+            catalogue_cache=args.catalogue_cache,
+            reference_data=args.reference_data,
+            state_file=args.state_file,
+            force=args.force,
+            report_folder=args.report_folder,
+            shard=args.shard,
+            shards=args.shards,
+            run_id=args.run_id,
+            journal=args.journal,
+            resume=args.resume,
+            dry_run=args.dry_run,
+            imports_seconds=imports_seconds,
+            started=started,
+        )
@@ -0,0 +1,76 @@
+import logging
+from glob import glob
+from hashlib import sha256
+from os.path import getmtime, join
+from uuid import UUID
+from zlib import crc32
+
+from hdx.utilities.errors_onexit import ErrorsOnExit
+from hdx.utilities.loader import load_json
+
+from instrumentation import RunReport
+
+logger = logging.getLogger(__name__)
+
+
+def get_shard(iso3, shards):
+    # crc32 rather than hash() which is salted per process
+    return crc32(iso3.upper().encode()) % shards
+
+
+def in_shard(iso3, shard, shards):
+    if shards <= 1:
+        return True
+    return get_shard(iso3, shards) == shard
+
+
+def get_metadata_iso3(metadata):
+    if len(metadata["Location"]) == 0:
+        return ""
+    return metadata["Location"][0]
+
+
+def get_shard_filename(shard, shards):
+    return f"run_report_{shard}_of_{shards}"
+
+
+def get_batch_id(run_id, organization_id):
+    # every shard of a run derives the same batch for an organization without having to share state
+    digest = sha256(f"{run_id}:{organization_id}".encode()).digest()
+    return str(UUID(bytes=digest[:16], version=4))
+
+
+def merge_shards(folder, run_id=None):
+    # only the reports of one run with the same number of shards are merged: those of run_id if given, otherwise of
+    # the most recently written report, so that stale reports left in the folder by earlier runs are not merged in
+    paths = sorted(glob(join(folder, f"{get_shard_filename('*', '*')}.json")))
+    shard_reports = [(path, load_json(path)) for path in paths]
+    candidates = [x for x in shard_reports if run_id is None or x[1]["shard"]["run_id"] == run_id]
+    shards = 0
+    if candidates:
+        latest = max(candidates, key=lambda x: getmtime(x[0]))[1]["shard"]
+        run_id = latest["run_id"]
+        shards = latest["shards"]
+    report = RunReport()
+    with ErrorsOnExit() as errors:
+        merged = set()
+        for path, shard_report in shard_reports:
+            shard = shard_report["shard"]
+            if shard["run_id"] != run_id or shard["shards"] != shards:
+                logger.warning(f"Ignoring {path} of run {shard['run_id']} with {shard['shards']} shards")
+                continue
+            merged.add(shard["shard"])
+            report.merge(shard_report)
+            for error in shard_report.get("errors", list()):
+                errors.add(error)
+        if not merged:
+            errors.add(f"No shard reports of run {run_id} found in {folder}!")
+        for shard in sorted(set(range(shards)) - merged):
+            errors.add(f"Report of shard {shard} of {shards} is missing!")
+        logger.info(f"Merged {len(merged)} shard reports of run {run_id} from {folder}")
+        report.add_section("shard", {"shards": shards, "run_id": run_id})
+        report.set("shards", len(merged))
+        report.set("errors", len(errors.errors))
+        report.add_section("errors", list(errors.errors))
+        report.log()
+        report.save(folder)
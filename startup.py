@@ -0,0 +1,86 @@
+import logging
+from os import makedirs
+from os.path import exists, getmtime, join
+from time import time
+
+import hxl
+from hdx.api.locations import Locations
+from hdx.data.resource import Resource
+from hdx.data.vocabulary import Vocabulary
+from hdx.location.country import Country
+from hdx.utilities.downloader import Download, DownloadError
+from hxl.input import InputOptions
+
+from caches import PersistentCache
+from instrumentation import run_report
+
+logger = logging.getLogger(__name__)
+
+
+class ReferenceData:
+    def __init__(self, folder=None, ttl=None):
+        # the countries feed, valid locations, approved vocabulary, tags mappings and formats are otherwise
+        # downloaded by the HDX library on first use in every run
+        self.folder = folder
+        self.ttl = ttl
+        self.cache = PersistentCache()
+        if folder:
+            makedirs(folder, exist_ok=True)
+            self.cache = PersistentCache(join(folder, "reference_data.json"), ttl)
+        self.loaded = set()
+
+    def is_fresh(self, path):
+        return exists(path) and (not self.ttl or time() - getmtime(path) <= self.ttl)
+
+    def load_countries(self):
+        path = join(self.folder, "countries.csv")
+        if not self.is_fresh(path):
+            try:
+                with Download() as downloader:
+                    downloader.download_file(Country._ochaurl, path=path, overwrite=True)
+            except DownloadError:
+                logger.exception("Could not download countries feed")
+                if not exists(path):
+                    return
+        Country.set_countriesdata(hxl.data(path, InputOptions(allow_local=True, encoding="utf-8")))
+        self.loaded.add("countries")
+
+    def load(self):
+        # installs the cached data where the HDX library looks before downloading so that anything not cached is
+        # still only downloaded when first used
+        if not self.folder:
+            return
+        with run_report.stage("reference_data"):
+            self.load_countries()
+            for name, install in (
+                ("validlocations", Locations.set_validlocations),
+                ("approved_vocabulary", self.set_approved_vocabulary),
+                ("tags_mappings", Vocabulary.set_tagsdict),
+                ("formats", Resource.set_formatsdict),
+            ):
+                found, value = self.cache.get(name)
+                if found:
+                    install(value)
+                    self.loaded.add(name)
+        logger.info(f"Loaded reference data from {self.folder}: {', '.join(sorted(self.loaded))}")
+
+    @staticmethod
+    def set_approved_vocabulary(vocabulary):
+        Vocabulary._approved_vocabulary = vocabulary
+
+    def save(self):
+        # caches whatever the HDX library downloaded during the run
+        if not self.folder:
+            return
+        approved_vocabulary = Vocabulary._approved_vocabulary
+        if approved_vocabulary is not None and hasattr(approved_vocabulary, "data"):
+            approved_vocabulary = approved_vocabulary.data
+        for name, value in (
+            ("validlocations", Locations._validlocations),
+            ("approved_vocabulary", approved_vocabulary),
+            ("tags_mappings", Vocabulary._tags_dict),
+            ("formats", Resource._formats_dict),
+        ):
+            if value and name not in self.loaded:
+                self.cache.set(name, value)
+        self.cache.save()
@@ -0,0 +1,105 @@
+import logging
+from threading import Lock
+
+from hdx.api.configuration import Configuration
+from hdx.data.vocabulary import Vocabulary
+
+logger = logging.getLogger(__name__)
+
+# tags removed and added by theme after mapping
+theme_rules = {
+    "COD_AB": (("baseline population",), ("administrative boundaries-divisions",)),
+    "COD_EM": (("baseline population",), ("administrative boundaries-divisions",)),
+    "COD_PS": (("administrative boundaries-divisions",), ("baseline population",)),
+}
+
+
+class TagNormalizer:
+    def __init__(self):
+        # the approved vocabulary and tags mappings are read once into a set and dict, after which the final
+        # tags of each distinct combination of catalogue tags and theme are computed once
+        self.lock = Lock()
+        self.approved = None
+        self.vocabulary_id = None
+        self.mappings = None
+        self.mapped = dict()
+        self.normalized = dict()
+
+    def load(self):
+        with self.lock:
+            if self.approved is not None:
+                return
+            vocabulary = Vocabulary.get_approved_vocabulary()
+            self.mappings = Vocabulary.read_tags_mappings()
+            self.vocabulary_id = vocabulary["id"]
+            self.approved = {x["name"] for x in vocabulary["tags"]}
+
+    def map_tag(self, tag):
+        # same mapping as Vocabulary.get_mapped_tag but checking approval against a set
+        tag = tag.lower()
+        mapped = self.mapped.get(tag)
+        if mapped is not None:
+            return mapped
+        tags_list_url = Configuration.read()["tags_list_url"]
+        tags = list()
+        whattodo = self.mappings.get(tag)
+        if whattodo is None:
+            if tag in self.approved:
+                tags.append(tag)
+            else:
+                logger.error(
+                    f"Unapproved tag {tag} not in tags mappings! For a list of approved tags see: {tags_list_url}"
+                )
+        else:
+            action = whattodo["Action to Take"]
+            if action == "ok":
+                if tag in self.approved:
+                    tags.append(tag)
+                else:
+                    logger.error(
+                        f"Tag {tag} is not in CKAN approved tags but is in tags mappings! For a list of approved tags "
+                        f"see: {tags_list_url}"
+                    )
+            elif action == "delete":
+                logger.info(f"Tag {tag} is invalid and won't be added! For a list of approved tags see: {tags_list_url}")
+            elif action == "merge":
+                for final_tag in whattodo["New Tag(s)"].split(";"):
+                    if final_tag.lower() in self.approved:
+                        tags.append(final_tag.lower())
+                    else:
+                        logger.error(
+                            f"Mapped tag {final_tag} is not in CKAN approved tags but is in tags mappings! For a list of "
+                            f"approved tags see: {tags_list_url}"
+                        )
+            else:
+                logger.error(f"Invalid action {action}!")
+        self.mapped[tag] = tags
+        return tags
+
+    def normalize(self, tags, theme):
+        # returns the final tags for a theme and whether some of the given tags could not be added
+        key = (tuple(tags), theme)
+        result = self.normalized.get(key)
+        if result is not None:
+            return result
+        self.load()
+        final_tags = list()
+        for tag in tags:
+            for mapped_tag in self.map_tag(tag):
+                if mapped_tag not in final_tags:
+                    final_tags.append(mapped_tag)
+        invalid = len(final_tags) < len(tags)
+        remove_tags, add_tags = theme_rules.get(theme, (tuple(), tuple()))
+        final_tags = [x for x in final_tags if x not in remove_tags]
+        for tag in add_tags:
+            for mapped_tag in self.map_tag(tag):
+                if mapped_tag not in final_tags:
+                    final_tags.append(mapped_tag)
+        result = final_tags, invalid
+        self.normalized[key] = result
+        return result
+
+    def get_tags(self, tags, theme):
+        # tags in the form HDX expects on a dataset
+        final_tags, invalid = self.normalize(tags, theme)
+        return [{"name": x, "vocabulary_id": self.vocabulary_id} for x in final_tags], invalid
@@ -0,0 +1,109 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import listdir
+from os.path import basename, join
+from threading import Thread
+
+import pytest
+from hdx.utilities.downloader import Download
+from hdx.utilities.loader import load_json
+from hdx.utilities.path import temp_dir
+
+from caches import HTTPCache
+from instrumentation import InstrumentedRetrieve
+
+
+class TestCaches:
+    @pytest.fixture(scope="function")
+    def server(self):
+        requests = list()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append((self.path, self.headers.get("If-None-Match")))
+                body = f'[{{"path": "{self.path}"}}]'.encode()
+                if self.path == "/count":
+                    body = f'[{{"count": {len(requests)}}}]'.encode()
+                etag = f'"{self.path}"'
+                if self.path == "/dataset" and self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                if self.path == "/dataset":
+                    self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        thread = Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        yield f"http://127.0.0.1:{httpd.server_port}", requests
+        httpd.shutdown()
+        httpd.server_close()
+
+    def test_http_cache(self, server):
+        url, requests = server
+        with temp_dir("test_caches") as folder:
+            with Download(user_agent="test") as downloader:
+                cache = HTTPCache(folder)
+                path, size = cache.fetch(downloader, f"{url}/dataset")
+                assert load_json(path) == [{"path": "/dataset"}]
+                assert size == 22
+                path, size = cache.fetch(downloader, f"{url}/dataset")
+                assert load_json(path) == [{"path": "/dataset"}]
+                assert size == 0
+                cache.fetch(downloader, f"{url}/nocache")
+                cache.fetch(downloader, f"{url}/nocache")
+                assert requests == [
+                    ("/dataset", None),
+                    ("/dataset", '"/dataset"'),
+                    ("/nocache", None),
+                    ("/nocache", None),
+                ]
+                assert (cache.hits, cache.revalidated, cache.misses) == (0, 1, 3)
+                cache.save()
+
+                cache = HTTPCache(folder, ttl=3600)
+                retriever = InstrumentedRetrieve(downloader, folder, folder, folder, http_cache=cache)
+                assert retriever.clone(downloader).download_json(f"{url}/dataset") == [{"path": "/dataset"}]
+                assert len(requests) == 4
+                assert cache.hits == 1
+
+    def test_evict(self, server):
+        url, requests = server
+        with temp_dir("test_caches") as folder:
+            with Download(user_agent="test") as downloader:
+                cache = HTTPCache(folder, ttl=3600, max_bytes=50)
+                for path in ("first", "second", "first", "third"):
+                    cache.release(cache.fetch(downloader, f"{url}/{path}")[0])
+                assert [x["url"] for x in cache.entries.values()] == [f"{url}/first", f"{url}/third"]
+                assert len(listdir(join(folder, "blobs"))) == 2
+                assert len(requests) == 3
+                # a body that is handed out is only deleted once it is released
+                path, _ = cache.fetch(downloader, f"{url}/first")
+                cache.release(cache.fetch(downloader, f"{url}/fourth")[0])
+                cache.release(cache.fetch(downloader, f"{url}/fifth")[0])
+                assert f"{url}/first" not in [x["url"] for x in cache.entries.values()]
+                assert load_json(path) == [{"path": "/first"}]
+                cache.release(path)
+                assert len(listdir(join(folder, "blobs"))) == 2
+
+    def test_changed_content(self, server):
+        url, requests = server
+        with temp_dir("test_caches") as folder:
+            with Download(user_agent="test") as downloader:
+                cache = HTTPCache(folder)
+                for _ in range(5):  # the body of /count changes on every request
+                    path, _ = cache.fetch(downloader, f"{url}/count")
+                    cache.release(path)
+                assert len(cache.entries) == 1
+                assert listdir(join(folder, "blobs")) == [basename(path)]
+                cache.save()
+                with open(join(folder, "blobs", "orphan"), "w") as f:
+                    f.write("left behind by an earlier run")
+                cache = HTTPCache(folder)
+                assert listdir(join(folder, "blobs")) == [basename(path)]
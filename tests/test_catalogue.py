@@ -0,0 +1,39 @@
+from os.path import join
+
+from hdx.utilities.loader import load_json
+from hdx.utilities.path import temp_dir
+
+from catalogue import Catalogue, get_digest
+
+
+class TestCatalogue:
+    def test_catalogue(self):
+        path = join("tests", "fixtures", "locations-all.json")
+        records = load_json(path)
+        for x in records:  # fields not used to generate datasets are dropped
+            del x["Visibility"]
+        digest = get_digest(path)
+        catalogue = Catalogue(digest)
+        for x in records:
+            catalogue.add(x)
+        assert [catalogue.get(i) for i in catalogue.select()] == records
+        expected = [
+            i
+            for i, x in enumerate(records)
+            if x["is_enhanced_cod"] and x["Theme"] in ("COD_AB", "COD_EM") and x["Location"][0].upper() in ("AFG", "COL")
+        ]
+        selected = catalogue.select(["AFG", "COL"], themes=["COD_AB", "COD_EM"], enhanced=True)
+        assert selected == expected
+        assert catalogue.select(["XXX"]) == []
+        latest = catalogue.select(version="Latest")
+        assert len(latest) < len(records)
+        assert all(any(r["Version"] == "Latest" for r in records[i]["Resources"]) for i in latest)
+
+        with temp_dir("test_catalogue") as folder:
+            catalogue_path = join(folder, "catalogue.json")
+            catalogue.save(catalogue_path)
+            assert Catalogue.load(catalogue_path, "another download") is None
+            loaded = Catalogue.load(catalogue_path, digest)
+            assert loaded.select(["AFG", "COL"], themes=["COD_AB", "COD_EM"], enhanced=True) == expected
+            assert loaded.get(expected[0]) == records[expected[0]]
+            assert loaded.get_field(expected[0], "DatasetTitle") == records[expected[0]]["DatasetTitle"]
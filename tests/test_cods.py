@@ -1,19 +1,34 @@
-from os.path import join
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import exists, join
+from threading import Thread
+from time import monotonic
+from uuid import UUID
 
 import pytest
+from ckanapi.errors import CKANAPIError
 from hdx.api.configuration import Configuration
 from hdx.api.locations import Locations
 from hdx.data.dataset import Dataset
+from hdx.data.hdxobject import HDXError
+from hdx.data.organization import Organization
+from hdx.data.resource import Resource
 from hdx.data.vocabulary import Vocabulary
 from hdx.location.country import Country
 from hdx.utilities.downloader import Download
 from hdx.utilities.errors_onexit import ErrorsOnExit
+from hdx.utilities.loader import load_json
 from hdx.utilities.path import temp_dir
 from hdx.utilities.retriever import Retrieve
 from hdx.utilities.useragent import UserAgent
 from hdx.utilities.uuid import is_valid_uuid
 
+from async_engine import AsyncCOD, iterate_async
 from cods import COD
+from hdx_datasets import DatasetIndex
+from resilience import Upstream
 
 
 class TestCods:
@@ -50,6 +65,33 @@ class TestCods:
             def read_from_hdx():
                 return None
 
+    @pytest.fixture(scope="function")
+    def offline(self, configuration, monkeypatch):
+        countries = ["AFG", "BGD", "COL", "ETH", "HTI", "IRQ", "MMR", "NGA", "SOM", "YEM"]
+        Locations.set_validlocations([{"name": x.lower(), "title": x} for x in countries])
+        Vocabulary.set_tagsdict(
+            {
+                "administrative divisions": {
+                    "Action to Take": "merge",
+                    "New Tag(s)": "administrative boundaries-divisions",
+                },
+            }
+        )
+        Resource.set_formatsdict(
+            {x: x for x in ["csv", "emf", "geodatabase", "geojson", "geoservice", "json", "mbtiles", "shp", "xls", "xlsx"]}
+        )
+
+        def autocomplete(name):
+            if "OCHA" in name:
+                return [{"id": str(UUID(bytes=md5(name.encode()).digest(), version=4))}]
+            return []
+
+        monkeypatch.setattr(Dataset, "read_from_hdx", staticmethod(lambda name: None))
+        monkeypatch.setattr(Organization, "autocomplete", staticmethod(autocomplete))
+        yield countries
+        Vocabulary.set_tagsdict(None)
+        Resource.set_formatsdict(None)
+
     @pytest.fixture(scope="function")
     def fixtures_folder(self):
         return join("tests", "fixtures")
@@ -69,6 +111,24 @@ class TestCods:
                     "Iraq - Subnational Administrative Boundaries",
                 ]
 
+    def test_get_all_datasets_metadata(self, configuration, fixtures_folder):
+        with temp_dir() as folder:
+            with Download() as downloader:
+                retriever = Retrieve(
+                    downloader, folder, fixtures_folder, folder, False, True
+                )
+                cod = COD(retriever, ErrorsOnExit())
+                datasets_metadata = cod.get_datasets_metadata(
+                    configuration["url"], enhanced_only=False, boundaries_only=False
+                )
+                records = load_json(join(fixtures_folder, "locations-all.json"))
+                for x in records:  # fields not used to generate datasets are dropped
+                    del x["Visibility"]
+                assert next(datasets_metadata) == records[0]
+                assert list(datasets_metadata) == records[1:]
+                datasets_metadata = cod.get_datasets_metadata(configuration["url"])
+                assert len(list(datasets_metadata)) == 118
+
     def test_get_datasets_metadata(self, configuration, fixtures_folder):
         with temp_dir() as folder:
             with Download() as downloader:
@@ -76,7 +136,7 @@ class TestCods:
                     downloader, folder, fixtures_folder, folder, False, True
                 )
                 cod = COD(retriever, ErrorsOnExit())
-                datasets_metadata = cod.get_datasets_metadata(configuration["url"], countries=["AFG"])
+                datasets_metadata = list(cod.get_datasets_metadata(configuration["url"], countries=["AFG"]))
                 assert datasets_metadata[0] == {
                     'DatasetTitle': 'Afghanistan - Subnational Administrative Boundaries',
                     'DatasetDescription': 'Afghanistan administrative level 0-2 and UNAMA region gazetteer and P-code geoservices.\r\n\r\nThis gazetteer is compatible with the [Afghanistan - Subnational Population Statistics](https://data.humdata.org/dataset/cod-ps-afg) gazetteer.\r\n\r\nOnly the gazetteer the the P-code geoservices can be made generally available. Humanitarian responders who want the administrative boundary files should make a request by clicking the \'Contact the contributor\' button (below) and including:\r\n\r\na) the following declaration:  "I agree not to share the data with any third party or publish it online without prior permission from AGCHO.  As per the agreement, the datasets are for humanitarian use only."\r\n\r\nb) name\r\n\r\nc) organization or cluster\r\n\r\nd) email address\r\n\r\nThe user will then receive a link to the boundary files, which may only be used according to the above restriction.',
@@ -112,7 +172,6 @@ class TestCods:
                     'Contributor': 'OCHA Field Information Services Section (FISS)',
                     'Location': ['afg'],
                     'Theme': 'COD_AB',
-                    'Visibility': 'True',
                     'License': 'Creative Commons Attribution for Intergovernmental Organisations',
                     'License_Other': '',
                     'Methodology': 'Other',
@@ -133,7 +192,7 @@ class TestCods:
                     downloader, folder, fixtures_folder, folder, False, True
                 )
                 cod = COD(retriever, ErrorsOnExit())
-                datasets_metadata = cod.get_datasets_metadata(configuration["url"], countries=["AFG"])
+                datasets_metadata = list(cod.get_datasets_metadata(configuration["url"], countries=["AFG"]))
                 dataset, batch = cod.generate_dataset(datasets_metadata[0])
                 assert is_valid_uuid(batch) is True
                 assert dataset == {
@@ -148,6 +207,7 @@ class TestCods:
                     'caveats': 'In-country humanitarian responders in Afghanistan can collect a copy of latest available datasets from OCHA Afghanistan as a member of the Information Management Working Group (IMWG).\r\n\r\nThese datasets are available for purchase from the [National Statistic and Information Authority]( https://www.nsia.gov.af/home) (NSIA)  in Afghanistan.',
                     'data_update_frequency': '365',
                     'cod_level': 'cod-enhanced',
+                    'private': False,
                     'maintainer': '196196be-6037-4488-8b71-d786adf4c081',
                     'owner_org': 'b3a25ac4-ac05-4991-923c-d25f47bef1ec',
                     'subnational': '1',
@@ -196,6 +256,66 @@ class TestCods:
                     }
                 ]
 
+    def test_generate_datasets(self, configuration, offline, fixtures_folder):
+        with temp_dir() as folder:
+            with Download() as downloader:
+                retriever = Retrieve(
+                    downloader, folder, fixtures_folder, folder, False, True
+                )
+                results = list()
+                for workers in (1, 8):
+                    errors = ErrorsOnExit()
+                    cod = COD(retriever, errors, workers=workers)
+                    datasets_metadata = list(cod.get_datasets_metadata(configuration["url"], countries=offline))
+                    datasets = list(cod.generate_datasets(datasets_metadata))
+                    batches = {dataset["owner_org"]: batch for dataset, batch in datasets if dataset}
+                    assert batches.items() <= cod.batches_by_org.items()
+                    assert cod.organizations.misses == len({x["Contributor"] for x in datasets_metadata})
+                    datasets = [(dataset, dataset.get_resources()) for dataset, _ in datasets if dataset]
+                    results.append((datasets, errors.errors))
+                assert len(results[0][0]) == 8
+                assert results[0][1] == [
+                    "Dataset: cod-ab-nga resources could not be added. Error: Supplied file type TopoJSON is invalid and could not be mapped to a known type!",
+                    "Dataset: cod-ab-yem has invalid tags!",
+                    "Dataset: cod-ab-yem resources could not be added. Error: Supplied file type Geopackage is invalid and could not be mapped to a known type!",
+                ]
+                assert results[0] == results[1]
+
+    def test_generate_all_versions(self, configuration, offline, fixtures_folder):
+        with temp_dir() as folder:
+            with Download() as downloader:
+                retriever = Retrieve(downloader, folder, fixtures_folder, folder, False, True)
+                cod = COD(retriever, ErrorsOnExit())
+                datasets_metadata = cod.get_datasets_metadata(configuration["url"], countries=["ETH", "SOM"])
+                eth, som = datasets_metadata
+                dataset, _ = cod.generate_dataset(eth, latest_only=False)
+                names = [x["name"] for x in dataset.get_resources()]
+                assert len(names) == 12
+                assert names[6:] == [
+                    "V1_00/ETH_EN (MapServer) (2020-10-13)",
+                    "V1_00/ETH_pcode (FeatureServer) (2020-10-13)",
+                    "V1_00/ETH_pcode (MapServer) (2020-10-13)",
+                    "V00_0/ETH_EN (MapServer) (2019-10-28)",
+                    "V00_0/ETH_pcode (FeatureServer) (2019-10-28)",
+                    "V00_0/ETH_pcode (MapServer) (2019-10-28)",
+                ]
+                assert dataset.get_reference_period()["startdate_str"][:10] == "2019-10-28"
+                # a historical resource published under the same url as the latest one is dropped
+                resources = [dict(x) for x in eth["Resources"]]
+                resources[-1]["DownloadURL"] = resources[0]["DownloadURL"]
+                dataset, _ = cod.generate_dataset({**eth, "Resources": resources}, latest_only=False)
+                names = [x["name"] for x in dataset.get_resources()]
+                assert len(names) == 11
+                assert "V1_00/ETH_pcode (MapServer) (2020-10-13)" not in names
+                dataset, _ = cod.generate_dataset(som, latest_only=False)
+                assert len(dataset.get_resources()) == 14
+                cod.max_resources = 5
+                dataset, _ = cod.generate_dataset(eth, latest_only=False)
+                assert len(dataset.get_resources()) == 5
+                cod.max_resources = None
+                dataset, _ = cod.generate_dataset(eth)
+                assert len(dataset.get_resources()) == 6
+
     def test_add_population_services(self, configuration, fixtures_folder):
         with temp_dir() as folder:
             with Download() as downloader:
@@ -224,3 +344,221 @@ class TestCods:
                         'resource_type': 'api', 'url_type': 'api'
                     }
                 ]
+
+    def test_generate_population_datasets(self, configuration, offline, fixtures_folder, monkeypatch):
+        def read_from_hdx(name):
+            if name == "cod-ps-afg":
+                return Dataset.load_from_json(join(fixtures_folder, "dataset-cod-ps-afg.json"))
+            return None
+
+        monkeypatch.setattr(Dataset, "read_from_hdx", staticmethod(read_from_hdx))
+        with temp_dir() as folder:
+            with Download() as downloader:
+                retriever = Retrieve(
+                    downloader, folder, fixtures_folder, folder, False, True
+                )
+                results = list()
+                for workers, probes in ((1, 1), (2, 5)):
+                    cod = COD(retriever, ErrorsOnExit(), workers=workers, probes=probes)
+                    datasets = list(cod.generate_population_datasets(["AFG", "SOM"], configuration["ps_url"]))
+                    assert datasets[1] == (None, None)
+                    dataset, batch = datasets[0]
+                    assert is_valid_uuid(batch) is True
+                    results.append(dataset.get_resources())
+                    dataset, _ = cod.add_population_services(dataset, "AFG", configuration["ps_url"])
+                    assert dataset.get_resources() == results[-1]
+                    assert cod.population_years.hits == 2
+                assert results[0] == results[1]
+                assert [x["description"] for x in results[0][-2:]] == [
+                    "Afghanistan administrative level 0 2021 population statistics",
+                    "Afghanistan administrative level 1 2021 population statistics",
+                ]
+
+    @pytest.fixture(scope="function")
+    def stub_server(self, fixtures_folder):
+        # serves the fixtures in place of the ITOS CODV2API
+        requests = list()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                if self.path == "/CODV2API/api/v1/Locations/all":
+                    filename = "locations-all.json"
+                else:
+                    parts = self.path.split("/")
+                    filename = f"{parts[-3]}_do-{parts[-1].lower()}.json"
+                path = join(fixtures_folder, filename)
+                if not exists(path):
+                    self.send_error(404)
+                    return
+                with open(path, "rb") as f:
+                    body = f.read()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        thread = Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        yield f"http://127.0.0.1:{httpd.server_port}", requests
+        httpd.shutdown()
+        httpd.server_close()
+
+    def test_population_probes(self, configuration, stub_server):
+        stub_url, requests = stub_server
+        ps_url = configuration["ps_url"].replace("https://apps.itos.uga.edu", stub_url)
+        with temp_dir() as folder:
+            with Download() as downloader:
+                retriever = Retrieve(downloader, folder, folder, folder, False, False)
+                years = COD(retriever, ErrorsOnExit()).get_population_years("AFG", ps_url)
+                assert list(years) == [0, 1]
+                assert len(requests) == 3
+                requests.clear()
+                with ThreadPoolExecutor(max_workers=5) as executor:
+                    cod = COD(retriever, ErrorsOnExit(), probes=5)
+                    assert cod.get_population_years("AFG", ps_url, executor) == years
+                # admin levels 0 and 1 exist so level 2 is the first missing one and level 4 is never probed
+                assert len(requests) <= 4
+                assert "/CODV2API/api/v1/themes/cod-ps/lookup/Get/4/do/AFG" not in requests
+
+                async def probe(retriever):
+                    async with AsyncCOD(COD(retriever, ErrorsOnExit()), concurrency=5) as engine:
+                        return await engine.get_population_years("AFG", ps_url)
+
+                requests.clear()
+                saved_folder = join(folder, "saved")
+                retriever = Retrieve(downloader, folder, saved_folder, folder, True, False)
+                assert asyncio.run(probe(retriever)) == years
+                assert len(requests) <= 4
+                assert "/CODV2API/api/v1/themes/cod-ps/lookup/Get/4/do/AFG" not in requests
+                # the saved responses are replayed without any request
+                requests.clear()
+                retriever = Retrieve(downloader, folder, saved_folder, folder, False, True)
+                assert asyncio.run(probe(retriever)) == years
+                assert requests == []
+
+    def test_population_circuit_open(self, configuration, offline, fixtures_folder, stub_server):
+        stub_url, requests = stub_server
+        ps_url = configuration["ps_url"].replace("https://apps.itos.uga.edu", stub_url)
+        with temp_dir() as folder:
+            with Download() as downloader:
+                retriever = Retrieve(downloader, folder, folder, folder, False, False)
+                errors = ErrorsOnExit()
+                cod = COD(retriever, errors, resilience={"threshold": 3, "cooldown": 60})
+                cod.upstreams["population"].opened = monotonic()
+                dataset = Dataset.load_from_json(join(fixtures_folder, "dataset-cod-ps-afg.json"))
+                # every country is reported as an error while the circuit is open rather than the run stopping
+                assert cod.add_population_services(dataset, "AFG", ps_url) == (None, None)
+                assert cod.add_population_services(dataset, "SOM", ps_url) == (None, None)
+
+                async def add(dataset, iso):
+                    async with AsyncCOD(cod, concurrency=5) as engine:
+                        return await engine.add_population_services(dataset, iso, ps_url)
+
+                assert asyncio.run(add(dataset, "AFG")) == (None, None)
+                assert len(errors.errors) == 3
+                for error in errors.errors:
+                    assert error.startswith("Dataset: cod-ps-afg population services could not be probed. Error: Circuit")
+                assert requests == []
+
+    def test_visibility(self, configuration, offline, fixtures_folder, monkeypatch):
+        def read_from_hdx(name):
+            if name == "cod-ab-afg":
+                return Dataset({"name": name, "private": True})
+            if name == "cod-ab-bgd":
+                raise HDXError(f"Failed when trying to read: {name}! (GET)") from ValueError("Not authorized")
+            return None
+
+        monkeypatch.setattr(Dataset, "read_from_hdx", staticmethod(read_from_hdx))
+        with temp_dir() as folder:
+            with Download() as downloader:
+                retriever = Retrieve(downloader, folder, fixtures_folder, folder, False, True)
+                cod = COD(retriever, ErrorsOnExit())
+                datasets_metadata = cod.get_datasets_metadata(configuration["url"], countries=["AFG", "BGD", "COL"])
+                afg, bgd, col = [x for x, _ in cod.generate_datasets(datasets_metadata)]
+                # existing datasets keep their visibility, new ones are public and it is left unset if the read failed
+                assert afg["private"] is True
+                assert "private" not in bgd
+                assert col["private"] is False
+
+    def test_hdx_read_errors(self, configuration, offline, fixtures_folder, monkeypatch):
+        reads = list()
+
+        def read_from_hdx(name):
+            reads.append(name)
+            try:
+                raise CKANAPIError(repr(["https://data.humdata.org/api/action/package_show", 503, "Unavailable"]))
+            except CKANAPIError as ex:
+                raise HDXError(f"Failed when trying to read: {name}! (GET)") from ex
+
+        monkeypatch.setattr(Dataset, "read_from_hdx", staticmethod(read_from_hdx))
+        with temp_dir() as folder:
+            with Download() as downloader:
+                retriever = Retrieve(downloader, folder, fixtures_folder, folder, False, True)
+                errors = ErrorsOnExit()
+                upstream = Upstream("hdx_read", retries=1, backoff=0, threshold=4, cooldown=60)
+                cod = COD(retriever, errors, hdx_datasets=DatasetIndex(upstream=upstream))
+                datasets_metadata = cod.get_datasets_metadata(configuration["url"], countries=["AFG", "BGD", "COL"])
+                assert list(cod.generate_datasets(datasets_metadata)) == [(None, None)] * 3
+                # the reads of the first two datasets are retried once after which the circuit is open
+                assert reads == ["cod-ab-afg", "cod-ab-afg", "cod-ab-bgd", "cod-ab-bgd"]
+                datasets = cod.generate_population_datasets(["AFG"], configuration["ps_url"])
+                assert list(datasets) == [(None, None)]
+                assert len(reads) == 4
+                assert errors.errors[0].startswith("Dataset: cod-ab-afg could not be read from HDX. Error: Failed")
+                assert errors.errors[2].startswith("Dataset: cod-ab-col could not be read from HDX. Error: Circuit")
+                assert errors.errors[3].startswith("Dataset: cod-ps-afg could not be read from HDX. Error: Circuit")
+                assert len(errors.errors) == 4
+
+    def test_async_engine(self, configuration, offline, fixtures_folder, stub_server, monkeypatch):
+        def read_from_hdx(name):
+            if name == "cod-ps-afg":
+                return Dataset.load_from_json(join(fixtures_folder, "dataset-cod-ps-afg.json"))
+            return None
+
+        monkeypatch.setattr(Dataset, "read_from_hdx", staticmethod(read_from_hdx))
+        stub_url, requests = stub_server
+        url = configuration["url"].replace("https://apps.itos.uga.edu", stub_url)
+        ps_url = configuration["ps_url"].replace("https://apps.itos.uga.edu", stub_url)
+        with temp_dir() as folder:
+            with Download() as downloader:
+                retriever = Retrieve(downloader, folder, fixtures_folder, folder, False, True)
+                cod = COD(retriever, ErrorsOnExit())
+                datasets_metadata = list(cod.get_datasets_metadata(configuration["url"], countries=offline))
+                datasets = [x.get_resources() for x, _ in cod.generate_datasets(datasets_metadata) if x]
+                population = list(cod.generate_population_datasets(["AFG", "SOM"], configuration["ps_url"]))
+
+                retriever = Retrieve(downloader, folder, fixtures_folder, folder, False, False)
+                errors = ErrorsOnExit()
+                cod = COD(retriever, errors)
+
+                async def run():
+                    async with AsyncCOD(cod, concurrency=4) as engine:
+                        metadata = list(await engine.get_datasets_metadata(url, countries=offline))
+                        generated = [x async for x in engine.generate_datasets(metadata)]
+                        dataset, batch = await engine.generate_dataset(metadata[0])
+                        assert batch == generated[0][1]
+                        population = [x async for x in engine.generate_population_datasets(["AFG", "SOM"], ps_url)]
+                        return metadata, generated, population
+
+                async_metadata, async_datasets, async_population = asyncio.run(run())
+                assert async_metadata == datasets_metadata
+                assert [x.get_resources() for x, _ in async_datasets if x] == datasets
+                assert all(batch == cod.batches_by_org[x["owner_org"]] for x, batch in async_datasets if x)
+                assert len(errors.errors) == 3
+                assert async_population[1] == (None, None)
+                resources = [
+                    dict(x, url=x["url"].replace(stub_url, "https://apps.itos.uga.edu"))
+                    for x in async_population[0][0].get_resources()
+                ]
+                assert resources == population[0][0].get_resources()
+                iterated = list(iterate_async(cod, 4, "generate_population_datasets", ["AFG", "SOM"], ps_url))
+                assert [x.get_resources() if x else None for x, _ in iterated] == [
+                    x.get_resources() if x else None for x, _ in async_population
+                ]
+                assert requests.count("/CODV2API/api/v1/Locations/all") == 1
+                assert "/CODV2API/api/v1/themes/cod-ps/lookup/Get/1/do/AFG" in requests
@@ -0,0 +1,39 @@
+from os.path import join
+
+from hdx.data.date_helper import DateHelper
+from hdx.utilities.loader import load_json
+
+from dateranges import get_reference_period, parse_daterange
+
+
+class TestDateranges:
+    @staticmethod
+    def get_reference_period_per_resource(dateranges):
+        startdate = None
+        enddate = None
+        ongoing = False
+        for daterange in dateranges:
+            date_info = DateHelper.get_reference_period_info(daterange)
+            if startdate is None or date_info["startdate"] < startdate:
+                startdate = date_info["startdate"]
+            if enddate is None or date_info["enddate"] > enddate:
+                enddate = date_info["enddate"]
+                ongoing = date_info["ongoing"]
+        if ongoing:
+            enddate = "*"
+        return startdate, enddate, ongoing
+
+    def test_get_reference_period(self):
+        parse_daterange.cache_clear()
+        records = load_json(join("tests", "fixtures", "locations-all.json"))
+        datasets_dateranges = dict()
+        for i, metadata in enumerate(records):
+            resources = metadata["Resources"]
+            datasets_dateranges[f"{i}-all"] = [x["daterange_for_data"] for x in resources]
+            datasets_dateranges[f"{i}-latest"] = [x["daterange_for_data"] for x in resources if x["Version"] == "Latest"]
+        expected = {name: self.get_reference_period_per_resource(x) for name, x in datasets_dateranges.items()}
+        assert {name: get_reference_period(x) for name, x in datasets_dateranges.items()} == expected
+        assert any(period[2] for period in expected.values())
+        assert get_reference_period([]) == (None, None, False)
+        cache_info = parse_daterange.cache_info()
+        assert cache_info.currsize < sum(len(x) for x in datasets_dateranges.values()) / 10
@@ -0,0 +1,90 @@
+from copy import deepcopy
+from os.path import join
+
+import pytest
+from hdx.api.configuration import Configuration
+from hdx.data.dataset import Dataset
+from hdx.data.resource import Resource
+from hdx.utilities.useragent import UserAgent
+
+from diffs import DatasetDiffer, diff_dataset
+from hdx_datasets import DatasetIndex
+
+
+class Index:
+    def __init__(self, datasets):
+        self.datasets = datasets
+
+    def read(self, name):
+        return self.datasets.get(name)
+
+
+class TestDiffs:
+    @pytest.fixture(scope="function")
+    def existing(self):
+        UserAgent.set_global("test")
+        Configuration._create(
+            hdx_read_only=True,
+            hdx_site="prod",
+            project_config_yaml=join("config", "project_configuration.yml"),
+        )
+        Resource.set_formatsdict({x: x for x in ["csv", "json", "xlsx"]})
+        yield Dataset.load_from_json(join("tests", "fixtures", "dataset-cod-ps-afg.json"))
+        Resource.set_formatsdict(None)
+
+    @staticmethod
+    def generate(existing, resources=None):
+        # a dataset as the scraper would generate it from what is on HDX
+        dataset = Dataset({x: deepcopy(existing[x]) for x in ("name", "title", "license_id", "dataset_date", "tags")})
+        if resources is None:
+            resources = existing.get_resources()
+        fields = ("name", "description", "url", "format")
+        dataset.add_update_resources([{x: y for x, y in resource.data.items() if x in fields} for resource in resources])
+        return dataset
+
+    def test_diff_dataset(self, existing):
+        assert diff_dataset(self.generate(existing), existing) is None
+        dataset = self.generate(existing, existing.get_resources()[:-1])
+        dataset["license_id"] = "hdx-other"
+        dataset["tags"] = [{"name": "baseline population", "vocabulary_id": "4e61d464"}]
+        resources = dataset.get_resources()
+        resources[0]["description"] = "New description"
+        diff = diff_dataset(dataset, existing)
+        assert diff["status"] == "changed"
+        assert list(diff["fields"]) == ["license_id", "tags"]
+        assert diff["fields"]["license_id"] == {"old": existing["license_id"], "new": "hdx-other"}
+        assert diff["resources"] == {
+            "removed": ["AFG_AdminBoundaries_TabularData.xlsx"],
+            "changed": {
+                "afg_admpop_adm1_2021_v2.csv": {
+                    "description": {"old": existing.get_resources()[0]["description"], "new": "New description"}
+                }
+            },
+        }
+
+    def test_differ(self, existing):
+        unchanged = self.generate(existing)
+        new = Dataset({"name": "cod-ps-som", "title": "Somalia"})
+        differ = DatasetDiffer(Index({"cod-ps-afg": existing}), workers=2)
+        diffs = differ.diff([unchanged, new])
+        assert diffs == [{"name": "cod-ps-som", "status": "new", "resources": {"added": []}}]
+        assert differ.unchanged == 1
+
+    def test_differ_population(self, existing):
+        # population services are set on the dataset read from the index which must not change what it diffs against
+        hdx_datasets = DatasetIndex()
+        hdx_datasets.datasets = {"cod-ps-afg": existing}
+        dataset = hdx_datasets.read("cod-ps-afg")
+        dataset.delete_resource(dataset.get_resources()[-1], delete=False)
+        resource = {"name": "AFG admin 0 population", "url": "https://apps.itos.uga.edu/0", "format": "json"}
+        dataset.add_update_resources([resource])
+        differ = DatasetDiffer(hdx_datasets)
+        diffs = differ.diff([dataset])
+        assert diffs == [
+            {
+                "name": "cod-ps-afg",
+                "status": "changed",
+                "resources": {"added": ["AFG admin 0 population"], "removed": ["AFG_AdminBoundaries_TabularData.xlsx"]},
+            }
+        ]
+        assert differ.unchanged == 0
@@ -0,0 +1,49 @@
+from os.path import join
+
+import pytest
+from hdx.api.configuration import Configuration
+from hdx.data.dataset import Dataset
+from hdx.data.resource import Resource
+from hdx.utilities.path import temp_dir
+from hdx.utilities.useragent import UserAgent
+
+from fingerprints import Fingerprints, get_fingerprint
+
+
+class TestFingerprints:
+    @pytest.fixture(scope="function")
+    def configuration(self):
+        UserAgent.set_global("test")
+        Configuration._create(
+            hdx_read_only=True,
+            hdx_site="prod",
+            project_config_yaml=join("config", "project_configuration.yml"),
+        )
+        return Configuration.read()
+
+    @pytest.fixture(scope="function")
+    def dataset(self, configuration):
+        dataset = Dataset({"name": "cod-ps-afg", "title": "Afghanistan - Subnational Population Statistics"})
+        dataset.resources = [Resource({"name": "AFG admin 0 population", "url": "https://apps.itos.uga.edu/0/AFG"})]
+        return dataset
+
+    def test_get_fingerprint(self, dataset):
+        fingerprint = get_fingerprint(dataset)
+        dataset["metadata_modified"] = "2023-06-01T10:00:00"
+        assert get_fingerprint(dataset) == fingerprint
+        dataset.get_resources()[0]["url"] = "https://apps.itos.uga.edu/1/AFG"
+        assert get_fingerprint(dataset) != fingerprint
+
+    def test_fingerprints(self, dataset):
+        fingerprint = get_fingerprint(dataset)
+        with temp_dir("test_fingerprints") as folder:
+            path = join(folder, "fingerprints.json")
+            fingerprints = Fingerprints(path)
+            assert fingerprints.is_unchanged("cod-ps-afg", fingerprint) is False
+            fingerprints.update("cod-ps-afg", fingerprint)
+            fingerprints.save()
+            fingerprints = Fingerprints(path)
+            assert fingerprints.is_unchanged("cod-ps-afg", fingerprint) is True
+            assert fingerprints.skipped == 1
+            fingerprints = Fingerprints(path, force=True)
+            assert fingerprints.is_unchanged("cod-ps-afg", fingerprint) is False
@@ -0,0 +1,56 @@
+from os.path import join
+
+import pytest
+from hdx.api.configuration import Configuration
+from hdx.data.dataset import Dataset
+from hdx.utilities.useragent import UserAgent
+
+from hdx_datasets import DatasetIndex
+
+
+class TestDatasetIndex:
+    @pytest.fixture(scope="function")
+    def configuration(self):
+        UserAgent.set_global("test")
+        Configuration._create(
+            hdx_read_only=True,
+            hdx_site="prod",
+            project_config_yaml=join("config", "project_configuration.yml"),
+        )
+        return Configuration.read()
+
+    @pytest.fixture(scope="function")
+    def calls(self, configuration, monkeypatch):
+        calls = list()
+
+        def search_in_hdx(**kwargs):
+            calls.append(kwargs["fq"])
+            datasets = [Dataset({"name": "cod-ab-afg"}), Dataset({"name": "cod-ps-afg"})]
+            if kwargs.get("include_private"):
+                datasets.append(Dataset({"name": "cod-ps-som", "private": True}))
+            return datasets
+
+        def read_from_hdx(name):
+            calls.append(name)
+            return Dataset({"name": name})
+
+        monkeypatch.setattr(Dataset, "search_in_hdx", staticmethod(search_in_hdx))
+        monkeypatch.setattr(Dataset, "read_from_hdx", staticmethod(read_from_hdx))
+        return calls
+
+    def test_read(self, calls):
+        hdx_datasets = DatasetIndex()
+        assert hdx_datasets.read("cod-ab-afg")["name"] == "cod-ab-afg"
+        hdx_datasets.prefetch()
+        dataset = hdx_datasets.read("cod-ps-afg")
+        assert dataset["name"] == "cod-ps-afg"
+        dataset["title"] = "Afghanistan"
+        assert "title" not in hdx_datasets.read("cod-ps-afg")
+        assert hdx_datasets.read("cod-ps-som")["private"] is True
+        assert hdx_datasets.read("cod-ps-yem") is None
+        assert hdx_datasets.read("myanmar-admin-boundaries")["name"] == "myanmar-admin-boundaries"
+        assert calls == [
+            "cod-ab-afg",
+            "name:cod-ab-* OR name:cod-em-* OR name:cod-ps-*",
+            "myanmar-admin-boundaries",
+        ]
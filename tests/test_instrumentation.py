@@ -0,0 +1,42 @@
+from os.path import join
+
+from hdx.utilities.downloader import Download
+from hdx.utilities.errors_onexit import ErrorsOnExit
+from hdx.utilities.loader import load_json
+from hdx.utilities.path import temp_dir
+
+from instrumentation import InstrumentedRetrieve, RunReport, run_report
+
+
+class TestInstrumentation:
+    def test_run_report(self):
+        report = RunReport()
+        errors = ErrorsOnExit()
+        errors.add("Dataset: cod-ab-afg has no source!")
+        with temp_dir("test_instrumentation") as folder:
+            with report.write_on_exit(folder, errors):
+                for _ in range(2):
+                    with report.stage("autocomplete"):
+                        pass
+                report.add("bytes_downloaded", 1000)
+                report.add("bytes_downloaded", 500)
+                report.add_section("uploads", [{"name": "cod-ab-afg", "outcome": "uploaded"}])
+            result = load_json(join(folder, "run_report.json"))
+            assert result["stages"]["autocomplete"]["calls"] == 2
+            assert result["values"]["bytes_downloaded"] == 1500
+            assert result["values"]["errors"] == 1
+            assert result["uploads"] == [{"name": "cod-ab-afg", "outcome": "uploaded"}]
+            with open(join(folder, "run_report.prom")) as f:
+                prometheus = f.read()
+            assert 'cods_stage_calls{stage="autocomplete"} 2\n' in prometheus
+            assert "cods_bytes_downloaded 1500\n" in prometheus
+
+    def test_instrumented_retrieve(self):
+        run_report.reset()
+        fixtures_folder = join("tests", "fixtures")
+        with temp_dir("test_instrumentation") as folder:
+            with Download() as downloader:
+                retriever = InstrumentedRetrieve(downloader, folder, fixtures_folder, folder, False, True)
+                retriever = retriever.clone(downloader)
+                retriever.download_json("https://apps.itos.uga.edu/do/AFG", file_prefix="0")
+        assert run_report.get_report()["stages"]["download"]["calls"] == 1
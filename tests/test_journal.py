@@ -0,0 +1,43 @@
+from os.path import join
+
+from hdx.data.hdxobject import HDXError
+from hdx.utilities.errors_onexit import ErrorsOnExit
+from hdx.utilities.path import temp_dir
+
+from journal import Journal
+from uploader import Uploader
+
+
+class Dataset(dict):
+    def create_in_hdx(self, **kwargs):
+        if self["name"] == "cod-ab-som":
+            raise HDXError("Failed when trying to create: cod-ab-som!")
+
+
+class TestJournal:
+    def test_resume(self):
+        with temp_dir("test_journal") as folder:
+            path = join(folder, "journal.jsonl")
+            journal = Journal(path)
+            journal.record("cod-ab-afg", "generated", "batch1", "org1")
+            journal.record("cod-ab-som", "generated", "batch2", "org2")
+            journal.record("cod-ps-afg", "population_services", "batch1", "org1")
+            uploader = Uploader(ErrorsOnExit(), journal=journal)
+            uploader.upload([[Dataset(name="cod-ab-afg"), "batch1"], [Dataset(name="cod-ab-som"), "batch2"]])
+            journal.close()
+            with open(path, "a") as f:
+                f.write('{"name": "cod-ps-afg", "sta')
+
+            journal = Journal(path, resume=True)
+            assert journal.is_uploaded("cod-ab-afg") is True
+            assert journal.get_stage("cod-ab-som") == "failed"
+            assert journal.get_stage("cod-ps-afg") == "population_services"
+            assert journal.get_stage("cod-ab-eth") is None
+            assert journal.get_batches() == {"org1": "batch1", "org2": "batch2"}
+            journal.record("cod-ab-som", "uploaded", "batch2")
+            journal.close()
+            assert Journal(path, resume=True).is_uploaded("cod-ab-som") is True
+
+            journal = Journal(path)
+            journal.close()
+            assert Journal(path, resume=True).entries == dict()
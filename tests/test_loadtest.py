@@ -0,0 +1,19 @@
+from benchmarks.loadtest import run_loadtest
+
+
+class TestLoadtest:
+    def test_run_loadtest(self):
+        result = run_loadtest(1, 0.0, 0.0, ["-co", "AFG,SOM", "-uw", "2"], {"upload_rate": 0})
+        values = result["values"]
+        assert values["datasets_in_catalogue"] == 2
+        assert values["datasets_generated"] == 2
+        assert values["datasets_uploaded"] == 4
+        assert result["errors"] == list()
+        outcomes = {x["name"]: x["outcome"] for x in result["uploads"]}
+        assert outcomes == {x: "uploaded" for x in ("cod-ab-afg", "cod-ab-som", "cod-ps-afg", "cod-ps-som")}
+        requests = result["requests"]
+        assert requests["itos_catalogue"] == {200: 1}
+        assert requests["itos_population"] == {200: 4, 404: 2}
+        assert requests["package_revise"] == {200: 4}
+        assert "package_search" not in requests
+        assert result["datasets_per_second"] > 0
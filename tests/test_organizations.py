@@ -0,0 +1,69 @@
+from os.path import join
+
+import pytest
+from hdx.data.hdxobject import HDXError
+from hdx.data.organization import Organization
+from hdx.utilities.path import temp_dir
+from requests.exceptions import ConnectionError
+
+from organizations import OrganizationResolver
+from resilience import Upstream
+
+
+class TestOrganizations:
+    @pytest.fixture(scope="function")
+    def lookups(self, monkeypatch):
+        lookups = list()
+
+        def autocomplete(name):
+            lookups.append(name)
+            if name == "OCHA-Somalia":
+                return [{"id": "29ec1d55-7c02-4a82-a2e1-9ed4a4d1a0e8"}]
+            return []
+
+        monkeypatch.setattr(Organization, "autocomplete", staticmethod(autocomplete))
+        return lookups
+
+    def test_resolve(self, lookups):
+        organizations = OrganizationResolver()
+        for _ in range(3):
+            assert organizations.resolve("OCHA Somalia") == "29ec1d55-7c02-4a82-a2e1-9ed4a4d1a0e8"
+            assert organizations.resolve("Unknown") is None
+        assert lookups == ["OCHA Somalia", "OCHA-Somalia", "Unknown", "Unknown"]
+        assert organizations.hits == 4
+        assert organizations.misses == 2
+
+    def test_persist(self, lookups):
+        with temp_dir("test_organizations") as folder:
+            path = join(folder, "organizations.json")
+            organizations = OrganizationResolver(path, 3600)
+            organizations.resolve("OCHA Somalia")
+            organizations.save()
+            organizations = OrganizationResolver(path, 3600)
+            assert organizations.resolve("OCHA Somalia") == "29ec1d55-7c02-4a82-a2e1-9ed4a4d1a0e8"
+            assert organizations.hits == 1
+            organizations = OrganizationResolver(path, -1)
+            organizations.resolve("OCHA Somalia")
+            assert organizations.misses == 1
+            assert len(lookups) == 4
+
+    def test_lookup_failure(self, monkeypatch):
+        lookups = list()
+
+        def autocomplete(name):
+            lookups.append(name)
+            if len(lookups) == 1:
+                raise HDXError("Failed when trying to autocomplete! (POST)") from ConnectionError("Connection aborted")
+            return [{"id": "29ec1d55-7c02-4a82-a2e1-9ed4a4d1a0e8"}]
+
+        monkeypatch.setattr(Organization, "autocomplete", staticmethod(autocomplete))
+        organizations = OrganizationResolver(upstream=Upstream("hdx_read", retries=1, backoff=0))
+        assert organizations.resolve("OCHA Somalia") == "29ec1d55-7c02-4a82-a2e1-9ed4a4d1a0e8"
+        assert lookups == ["OCHA Somalia", "OCHA Somalia"]
+        # a lookup that still fails after the retries raises and is not cached
+        organizations = OrganizationResolver(upstream=Upstream("hdx_read"))
+        lookups.clear()
+        with pytest.raises(HDXError):
+            organizations.resolve("OCHA Somalia")
+        assert organizations.resolve("OCHA Somalia") == "29ec1d55-7c02-4a82-a2e1-9ed4a4d1a0e8"
+        assert organizations.misses == 2
@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+from ckanapi.errors import CKANAPIError
+from hdx.data.hdxobject import HDXError
+from hdx.utilities.retriever import DownloadError
+from requests import HTTPError, Response
+from requests.exceptions import ConnectionError
+
+from instrumentation import run_report
+from resilience import CircuitOpenError, Upstream, is_not_found, is_transient
+
+
+def get_download_error(status):
+    response = Response()
+    response.status_code = status
+    try:
+        try:
+            raise HTTPError(f"{status} Error", response=response)
+        except HTTPError as ex:
+            raise DownloadError("Download of https://apps.itos.uga.edu failed!") from ex
+    except DownloadError as ex:
+        return ex
+
+
+def get_hdx_error(cause):
+    try:
+        try:
+            raise cause
+        except Exception as ex:
+            raise HDXError("Failed when trying to read: cod-ps-afg!") from ex
+    except HDXError as ex:
+        return ex
+
+
+class Flaky:
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        return "ok"
+
+
+class TestResilience:
+    @pytest.fixture(scope="function")
+    def upstream(self):
+        run_report.reset()
+        return Upstream("itos_population", retries=2, backoff=0, threshold=3, cooldown=60)
+
+    def test_classification(self):
+        assert is_not_found(get_download_error(404)) is True
+        assert is_transient(get_download_error(404)) is False
+        assert is_transient(get_download_error(503)) is True
+        assert is_transient(get_download_error(429)) is True
+        assert is_transient(get_download_error(400)) is False
+        assert is_transient(ConnectionError("Connection refused")) is True
+        assert is_not_found(FileNotFoundError("0_do-afg.json")) is True
+        assert is_transient(ValueError("Invalid JSON")) is False
+        url = "https://data.humdata.org/api/action/package_show"
+        assert is_transient(get_hdx_error(CKANAPIError(repr([url, 503, "Service Unavailable"])))) is True
+        assert is_transient(get_hdx_error(CKANAPIError(repr([url, 403, "Forbidden 503"])))) is False
+        assert is_transient(get_hdx_error(CKANAPIError("Unexpected response 503"))) is False
+        assert is_transient(get_hdx_error(ValueError("Invalid dataset id 5503a2c1-e50b-4d2c"))) is False
+        assert is_transient(get_hdx_error(ConnectionError("Connection aborted"))) is True
+
+    def test_retry(self, upstream):
+        function = Flaky([get_download_error(503), ConnectionError("Connection reset")])
+        assert upstream.call(function) == "ok"
+        assert function.calls == 3
+        function = Flaky([get_download_error(404)])
+        with pytest.raises(DownloadError):
+            upstream.call(function)
+        assert function.calls == 1
+        histogram = run_report.get_report()["histograms"]["itos_population"]
+        assert histogram["calls"] == 4
+        assert histogram["outcomes"] == {"transient": 2, "ok": 1, "not_found": 1}
+        assert histogram["buckets"]["0.05"] == 4
+        prometheus = run_report.get_prometheus()
+        assert 'cods_endpoint_seconds_count{endpoint="itos_population"} 4\n' in prometheus
+        assert 'cods_endpoint_outcomes{endpoint="itos_population",outcome="not_found"} 1\n' in prometheus
+
+    def test_circuit_breaker(self, upstream):
+        function = Flaky([get_download_error(503)] * 4)
+        with pytest.raises(DownloadError):
+            upstream.call(function)
+        assert function.calls == 3
+        with pytest.raises(CircuitOpenError):
+            upstream.call(function)
+        assert function.calls == 3
+        upstream.opened -= upstream.cooldown  # after the cooldown one trial call is let through
+        with pytest.raises(DownloadError):
+            upstream.call(function)
+        assert function.calls == 4
+        with pytest.raises(CircuitOpenError):
+            upstream.call(function)
+        upstream.opened -= upstream.cooldown
+        assert upstream.call(function) == "ok"
+        assert upstream.opened is None
+        outcomes = run_report.get_report()["histograms"]["itos_population"]["outcomes"]
+        assert outcomes == {"transient": 4, "rejected": 2, "ok": 1}
+
+    def test_call_async(self, upstream):
+        async def download():
+            return function()
+
+        function = Flaky([asyncio.TimeoutError()])
+        result = asyncio.run(upstream.call_async(download, transient_errors=(asyncio.TimeoutError,)))
+        assert result == "ok"
+        assert function.calls == 2
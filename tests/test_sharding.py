@@ -0,0 +1,63 @@
+from os.path import join
+
+import pytest
+from hdx.utilities.errors_onexit import ErrorsOnExit
+from hdx.utilities.loader import load_json
+from hdx.utilities.path import temp_dir
+from hdx.utilities.uuid import is_valid_uuid
+
+from cods import COD
+from instrumentation import RunReport
+from sharding import get_batch_id, get_shard, get_shard_filename, in_shard, merge_shards
+
+
+class TestSharding:
+    def test_in_shard(self):
+        countries = ["AFG", "BGD", "COL", "ETH", "HTI", "IRQ", "MMR", "NGA", "SOM", "YEM"]
+        shards = [[c for c in countries if in_shard(c, shard, 3)] for shard in range(3)]
+        assert sorted(sum(shards, list())) == countries
+        assert all(len(shard) > 0 for shard in shards)
+        assert get_shard("afg", 3) == get_shard("AFG", 3)
+        assert all(in_shard(c, 0, 1) for c in countries)
+
+    def test_get_batch(self):
+        batch = get_batch_id("2026-10-18", "29ec1d55-7c02-4a82-a2e1-9ed4a4d1a0e8")
+        assert is_valid_uuid(batch)
+        cods = [COD(None, ErrorsOnExit(), run_id="2026-10-18") for _ in range(2)]
+        assert cods[0].get_batch("29ec1d55-7c02-4a82-a2e1-9ed4a4d1a0e8") == batch
+        assert cods[1].get_batch("29ec1d55-7c02-4a82-a2e1-9ed4a4d1a0e8") == batch
+        assert cods[0].get_batch("e9ea3bae-5e3b-4c4c-9c4e-d3a6a6e8b8f1") != batch
+        assert get_batch_id("2026-10-19", "29ec1d55-7c02-4a82-a2e1-9ed4a4d1a0e8") != batch
+
+    def test_merge_shards(self):
+        with temp_dir("test_sharding") as folder:
+            # a stale report of an earlier run and one of the same run with a different number of shards
+            for shard, shards, run_id in ((1, 3, "2026-10-17"), (1, 4, "2026-10-18")):
+                report = RunReport()
+                report.add_section("shard", {"shard": shard, "shards": shards, "run_id": run_id})
+                report.set("datasets_uploaded", 10)
+                report.save(folder, get_shard_filename(shard, shards))
+            for shard, error in ((0, "Dataset: cod-ab-afg has no source!"), (2, None)):
+                report = RunReport()
+                report.add_section("shard", {"shard": shard, "shards": 3, "run_id": "2026-10-18"})
+                report.set("startup_seconds", 1.5 + shard)
+                report.add_section("uploads", [{"name": f"cod-ab-{shard}", "outcome": "uploaded"}])
+                errors = ErrorsOnExit()
+                if error:
+                    errors.add(error)
+                with report.write_on_exit(folder, errors, get_shard_filename(shard, 3)):
+                    report.add_time("generate_dataset", 2.0)
+                    report.set("datasets_uploaded", 1)
+            with pytest.raises(SystemExit):
+                merge_shards(folder, "2026-10-18")
+            result = load_json(join(folder, "run_report.json"))
+        assert result["stages"]["generate_dataset"] == {"calls": 2, "seconds": 4.0}
+        assert result["values"]["datasets_uploaded"] == 2
+        assert result["values"]["startup_seconds"] == 3.5
+        assert result["values"]["shards"] == 2
+        assert result["shard"] == {"shards": 3, "run_id": "2026-10-18"}
+        assert result["uploads"] == [
+            {"name": "cod-ab-0", "outcome": "uploaded"},
+            {"name": "cod-ab-2", "outcome": "uploaded"},
+        ]
+        assert result["errors"] == ["Dataset: cod-ab-afg has no source!", "Report of shard 1 of 3 is missing!"]
@@ -0,0 +1,58 @@
+from os.path import dirname, join
+from shutil import copyfile
+
+import hdx.location
+import pytest
+from hdx.api.configuration import Configuration
+from hdx.api.locations import Locations
+from hdx.data.resource import Resource
+from hdx.data.vocabulary import Vocabulary
+from hdx.location.country import Country
+from hdx.utilities.path import temp_dir
+from hdx.utilities.useragent import UserAgent
+
+from startup import ReferenceData
+
+
+class TestStartup:
+    @pytest.fixture(scope="function")
+    def configuration(self):
+        UserAgent.set_global("test")
+        Configuration._create(
+            hdx_read_only=True,
+            hdx_site="prod",
+            project_config_yaml=join("config", "project_configuration.yml"),
+        )
+        return Configuration.read()
+
+    def test_reference_data(self, configuration):
+        with temp_dir("test_startup") as folder:
+            copyfile(
+                join(dirname(hdx.location.__file__), "Countries & Territories Taxonomy MVP - C&T Taxonomy with HXL Tags.csv"),
+                join(folder, "countries.csv"),
+            )
+            Country._countriesdata = None
+            Locations.set_validlocations(None)
+            Vocabulary._approved_vocabulary = {"tags": [{"name": "geodata"}], "id": "1", "name": "approved"}
+            Vocabulary.set_tagsdict({"gis": {"Action to Take": "merge", "New Tag(s)": "geodata"}})
+            Resource.set_formatsdict({"shp": "shp"})
+            reference_data = ReferenceData(folder, 3600)
+            reference_data.load()
+            assert reference_data.loaded == {"countries"}
+            assert Country.get_country_name_from_iso3("AFG") == "Afghanistan"
+            reference_data.save()
+
+            Country._countriesdata = None
+            Vocabulary._approved_vocabulary = None
+            Vocabulary.set_tagsdict(None)
+            Resource.set_formatsdict(None)
+            reference_data = ReferenceData(folder, 3600)
+            reference_data.load()
+            assert reference_data.loaded == {"countries", "approved_vocabulary", "tags_mappings", "formats"}
+            assert Country.get_iso3_country_code("Somalia") == "SOM"
+            assert Vocabulary.get_approved_vocabulary()["tags"] == [{"name": "geodata"}]
+            assert Vocabulary.read_tags_mappings()["gis"]["New Tag(s)"] == "geodata"
+            assert Resource.get_mapped_format("SHP") == "shp"
+            Vocabulary._approved_vocabulary = None
+            Vocabulary.set_tagsdict(None)
+            Resource.set_formatsdict(None)
@@ -0,0 +1,77 @@
+from os.path import join
+
+import pytest
+from hdx.api.configuration import Configuration
+from hdx.data.dataset import Dataset
+from hdx.data.vocabulary import Vocabulary
+from hdx.utilities.loader import load_json
+from hdx.utilities.useragent import UserAgent
+
+from tags import TagNormalizer
+
+
+class TestTags:
+    @pytest.fixture(scope="function")
+    def configuration(self):
+        UserAgent.set_global("test")
+        Configuration._create(
+            hdx_read_only=True,
+            hdx_site="prod",
+            project_config_yaml=join("config", "project_configuration.yml"),
+        )
+        Vocabulary._approved_vocabulary = {
+            "tags": [
+                {"name": "administrative boundaries-divisions"},
+                {"name": "baseline population"},
+                {"name": "geodata"},
+                {"name": "gazetteer"},
+            ],
+            "id": "4e61d464-4943-4e97-973a-84673c1aaa87",
+            "name": "approved",
+        }
+        Vocabulary.set_tagsdict(
+            {
+                "administrative divisions": {
+                    "Action to Take": "merge",
+                    "New Tag(s)": "administrative boundaries-divisions",
+                },
+                "population": {"Action to Take": "delete", "New Tag(s)": None},
+            }
+        )
+        yield Configuration.read()
+        Vocabulary.set_tagsdict(None)
+        Vocabulary._approved_vocabulary = None
+
+    @staticmethod
+    def add_tags(tags, theme):
+        # the tagging that generate_dataset did before TagNormalizer
+        dataset = Dataset({"name": "test"})
+        dataset.add_tags(tags)
+        invalid = len(dataset.get_tags()) < len(tags)
+        if theme in ["COD_AB", "COD_EM"]:
+            if "baseline population" in dataset.get_tags():
+                dataset.remove_tag("baseline population")
+            if "administrative boundaries-divisions" not in dataset.get_tags():
+                dataset.add_tag("administrative boundaries-divisions")
+        if theme == "COD_PS":
+            if "baseline population" not in dataset.get_tags():
+                dataset.add_tag("baseline population")
+            if "administrative boundaries-divisions" in dataset.get_tags():
+                dataset.remove_tag("administrative boundaries-divisions")
+        return dataset.get("tags", list()), invalid
+
+    def test_get_tags(self, configuration):
+        normalizer = TagNormalizer()
+        records = load_json(join("tests", "fixtures", "locations-all.json"))
+        for metadata in records:
+            tags = [t for t in metadata["Tags"] if t.replace(" ", "") != "commonoperationaldataset-cod"]
+            for theme in ("COD_AB", "COD_EM", "COD_PS", None):
+                assert normalizer.get_tags(tags, theme) == self.add_tags(tags, theme)
+        assert len(normalizer.normalized) < len(records) * 4
+        assert normalizer.get_tags(["Population", "Gazetteer"], "COD_PS") == (
+            [
+                {"name": "gazetteer", "vocabulary_id": "4e61d464-4943-4e97-973a-84673c1aaa87"},
+                {"name": "baseline population", "vocabulary_id": "4e61d464-4943-4e97-973a-84673c1aaa87"},
+            ],
+            True,
+        )
@@ -0,0 +1,132 @@
+from threading import Event, Thread
+
+import pytest
+from hdx.data.hdxobject import HDXError
+from hdx.utilities.errors_onexit import ErrorsOnExit
+from requests.exceptions import ConnectionError
+
+from uploader import TokenBucket, Uploader, is_transient
+
+
+class Dataset(dict):
+    def __init__(self, name, failures, calls):
+        super().__init__(name=name)
+        self.failures = failures
+        self.calls = calls
+
+    def create_in_hdx(self, batch, **kwargs):
+        self.calls.append((self["name"], batch))
+        if self.failures:
+            ex = self.failures.pop(0)
+            try:
+                raise ex
+            except Exception as cause:
+                raise HDXError(f"Failed when trying to create: {self['name']}!") from cause
+
+
+class TestUploader:
+    @pytest.fixture(scope="function")
+    def calls(self):
+        return list()
+
+    def test_is_transient(self):
+        try:
+            raise HDXError("Failed") from ConnectionError("Connection aborted")
+        except HDXError as ex:
+            assert is_transient(ex) is True
+        try:
+            raise HDXError("Failed") from ValueError("Invalid dataset")
+        except HDXError as ex:
+            assert is_transient(ex) is False
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(1000)
+        for _ in range(10):
+            bucket.acquire()
+        assert bucket.tokens < 1
+
+    @pytest.mark.parametrize("workers", [1, 4])
+    def test_upload(self, calls, workers):
+        datasets = [
+            [Dataset("cod-ab-afg", [ConnectionError("Connection aborted")], calls), "batch1"],
+            [Dataset("cod-ab-som", [ValueError("Invalid dataset")], calls), "batch2"],
+            [Dataset("cod-ps-afg", [], calls), "batch1"],
+        ]
+        errors = ErrorsOnExit()
+        uploader = Uploader(errors, workers, retries=2, backoff=0)
+        results = uploader.upload(datasets)
+        assert [(x["name"], x["outcome"], x["attempts"]) for x in results] == [
+            ("cod-ab-afg", "uploaded", 2),
+            ("cod-ab-som", "failed", 1),
+            ("cod-ps-afg", "uploaded", 1),
+        ]
+        assert errors.errors == ["Dataset: cod-ab-som, error: Failed when trying to create: cod-ab-som!"]
+        batch1 = [x for x in calls if x[1] == "batch1"]
+        assert batch1 == [("cod-ab-afg", "batch1"), ("cod-ab-afg", "batch1"), ("cod-ps-afg", "batch1")]
+
+    def test_backpressure(self, calls):
+        uploaded = Event()
+
+        class SlowDataset(Dataset):
+            def create_in_hdx(self, batch, **kwargs):
+                uploaded.wait(5)
+                super().create_in_hdx(batch, **kwargs)
+
+        uploader = Uploader(ErrorsOnExit())
+        uploader.start(queue_size=1)
+        uploader.submit(SlowDataset("cod-ab-afg", [], calls), "batch1")
+        uploader.submit(SlowDataset("cod-ab-som", [], calls), "batch2")
+        submitter = Thread(target=uploader.submit, args=(SlowDataset("cod-ps-afg", [], calls), "batch1"))
+        submitter.start()
+        submitter.join(0.2)
+        assert submitter.is_alive() is True
+        assert calls == []
+        uploaded.set()
+        submitter.join()
+        results = uploader.join()
+        assert [(x["name"], x["outcome"]) for x in results] == [
+            ("cod-ab-afg", "uploaded"),
+            ("cod-ab-som", "uploaded"),
+            ("cod-ps-afg", "uploaded"),
+        ]
+
+    def test_batches(self, calls):
+        # the datasets of a batch are uploaded in order whichever worker takes them, without holding back other batches
+        uploaded = Event()
+
+        class SlowDataset(Dataset):
+            def create_in_hdx(self, batch, **kwargs):
+                uploaded.wait(5)
+                super().create_in_hdx(batch, **kwargs)
+
+        uploader = Uploader(ErrorsOnExit(), 2)
+        uploader.start(queue_size=2)
+        uploader.submit(SlowDataset("cod-ab-afg", [], calls), "batch1")
+        for name in ("cod-ps-afg", "cod-em-afg", "cod-hp-afg"):
+            uploader.submit(Dataset(name, [], calls), "batch1")
+        uploader.submit(Dataset("cod-ab-som", [], calls), "batch2")
+        uploader.submit(Dataset("cod-ab-col", [], calls), "batch3")
+        for _ in range(50):
+            if len(calls) == 2:
+                break
+            uploaded.wait(0.01)
+        assert calls == [("cod-ab-som", "batch2"), ("cod-ab-col", "batch3")]
+        uploaded.set()
+        results = uploader.join()
+        assert [x["outcome"] for x in results] == ["uploaded"] * 6
+        assert [x[0] for x in calls if x[1] == "batch1"] == ["cod-ab-afg", "cod-ps-afg", "cod-em-afg", "cod-hp-afg"]
+
+    def test_join_after_failure(self, calls):
+        # run.py joins the uploader however generation ends so that no upload is cut short
+        uploader = Uploader(ErrorsOnExit())
+        uploader.start(queue_size=1)
+        assert not any(thread.daemon for thread in uploader.threads)
+        results = None
+        with pytest.raises(ValueError):
+            try:
+                uploader.submit(Dataset("cod-ab-afg", [], calls), "batch1")
+                raise ValueError("Generation failed")
+            finally:
+                results = uploader.join()
+        assert [(x["name"], x["outcome"]) for x in results] == [("cod-ab-afg", "uploaded")]
+        assert all(not thread.is_alive() for thread in uploader.threads)
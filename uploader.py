@@ -0,0 +1,186 @@
+import logging
+from queue import Queue
+from threading import Lock, Semaphore, Thread
+from time import monotonic, perf_counter, sleep
+
+from hdx.data.hdxobject import HDXError
+
+from instrumentation import run_report
+from resilience import is_transient
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class Uploader:
+    def __init__(self, errors, workers=1, rate=None, retries=0, backoff=1, journal=None):
+        self.errors = errors
+        self.journal = journal
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.report = list()
+
+    def upload(self, datasets):
+        self.start()
+        for dataset, batch in datasets:
+            self.submit(dataset, batch)
+        return self.join()
+
+    def start(self, queue_size=1):
+        # the workers take datasets from one shared queue, while the datasets of the same batch (ie. organization)
+        # are uploaded one after the other in submission order so that each organization's activity stream is grouped
+        # as before. Submit blocks once queue_size datasets per worker are waiting besides those being uploaded, so
+        # that uploads lagging behind generation hold it back
+        workers = max(self.workers, 1)
+        self.queue = Queue()
+        self.slots = Semaphore((queue_size + 1) * workers)
+        self.lock = Lock()
+        self.batches = dict()
+        self.results = list()
+        # the threads are not daemons so that the process cannot exit part way through an upload
+        self.threads = [Thread(target=self.consume) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, dataset, batch):
+        start = perf_counter()
+        self.slots.acquire()
+        run_report.add_time("upload_backpressure", perf_counter() - start)
+        index = len(self.results)
+        self.results.append(None)
+        with self.lock:
+            state = self.batches.setdefault(batch, {"submitted": 0, "next": 0, "active": False, "waiting": dict()})
+            sequence = state["submitted"]
+            state["submitted"] += 1
+        self.queue.put((index, sequence, dataset, batch))
+
+    def claim(self, item):
+        # returns the item if its worker is to upload it now. Otherwise it is left for the worker uploading its batch,
+        # which could also be the worker that took the dataset submitted before it but has not claimed it yet
+        _, sequence, _, batch = item
+        state = self.batches[batch]
+        if state["active"] or sequence != state["next"]:
+            state["waiting"][sequence] = item
+            return None
+        state["active"] = True
+        return item
+
+    def advance(self, batch):
+        # returns the next dataset of the batch if it is waiting, otherwise the batch is free to be claimed
+        state = self.batches[batch]
+        state["next"] += 1
+        item = state["waiting"].pop(state["next"], None)
+        if item is None:
+            state["active"] = False
+        return item
+
+    def consume(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            with self.lock:
+                item = self.claim(item)
+            while item is not None:
+                index, _, dataset, batch = item
+                item = None  # the dataset is freed once uploaded
+                self.results[index] = self.try_upload_dataset(dataset, batch)
+                dataset = None
+                self.slots.release()
+                with self.lock:
+                    item = self.advance(batch)
+
+    def try_upload_dataset(self, dataset, batch):
+        try:
+            return self.upload_dataset(dataset, batch)
+        except Exception as ex:
+            logger.exception(f"Dataset: {dataset['name']} could not be uploaded")
+            if self.journal is not None:
+                self.journal.record(dataset["name"], "failed", batch)
+            return {
+                "name": dataset["name"],
+                "batch": batch,
+                "outcome": "failed",
+                "attempts": 1,
+                "seconds": 0,
+                "error": f"Dataset: {dataset['name']}, error: {ex}",
+            }
+
+    def join(self):
+        # waits for the queued uploads and returns their results in submission order
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        results = [x for x in self.results if x is not None]  # a submit may have been interrupted
+        for result in results:
+            if result["error"]:
+                self.errors.add(result["error"])
+            del result["error"]
+            self.report.append(result)
+        return results
+
+    def upload_dataset(self, dataset, batch):
+        name = dataset["name"]
+        start = monotonic()
+        attempt = 0
+        error = None
+        while True:
+            attempt += 1
+            self.bucket.acquire()
+            try:
+                with run_report.stage("create_in_hdx"):
+                    dataset.create_in_hdx(
+                        hxl_update=False,
+                        remove_additional_resources=True,
+                        updated_by_script="HDX Scraper: CODS",
+                        batch=batch,
+                        ignore_fields=["num_of_rows", "resource:description"],
+                    )
+                break
+            except HDXError as ex:
+                if attempt <= self.retries and is_transient(ex):
+                    wait = self.backoff * 2 ** (attempt - 1)
+                    logger.warning(f"Dataset: {name} upload attempt {attempt} failed, retrying in {wait}s")
+                    sleep(wait)
+                    continue
+                logger.exception(f"Dataset: {name} could not be uploaded")
+                error = f"Dataset: {name}, error: {ex}"
+                break
+        seconds = round(monotonic() - start, 3)
+        outcome = "failed" if error else "uploaded"
+        logger.info(f"Dataset: {name} {outcome} in {seconds}s after {attempt} attempt(s)")
+        if self.journal is not None:
+            self.journal.record(name, outcome, batch)
+        return {
+            "name": name,
+            "batch": batch,
+            "outcome": outcome,
+            "attempts": attempt,
+            "seconds": seconds,
+            "error": error,
+        }